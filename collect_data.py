@@ -1,17 +1,18 @@
 import argparse
+import multiprocessing as mp
 import os
-import pickle
 import random
 
 import gym
 import numpy as np
-from skimage.transform import resize
 from IPython import embed
 
 import common_args
+import registry
+from columnar import ColumnarWriter, columnar_path, trajs_to_columns
 from envs import darkroom_env, bandit_env
-from ctrls.ctrl_bandit import ThompsonSamplingPolicy
-from evals import eval_bandit
+from image_utils import resize_images
+from ctrls.ctrl_bandit import LinearThompsonSamplingPolicy
 from utils import (
     build_bandit_data_filename,
     build_linear_bandit_data_filename,
@@ -53,31 +54,70 @@ def rollin_bandit(env, cov, orig=False):
     return xs, us, xps, rs
 
 
-def rollin_linear_bandit_vec(envs):
-    H = envs[0].H_context
+def rollin_bandit_vec(means, H, var, type='uniform'):
+    """
+    Vectorized version of rollin_bandit over a batch of bandits.
+    Draws the behavior policies, pulled arms and rewards of all envs and
+    steps at once. Returns arrays with a leading (n_envs,) dimension.
+    """
+    n_envs, dim = means.shape
+    var = np.broadcast_to(var, (n_envs,))
+
+    cov = np.random.choice(
+        [0.0, .1, .2, .3, .4, .5, .6, .7, .8, .9, 1.0], size=n_envs)
+    probs = np.random.dirichlet(np.ones(dim), size=n_envs)
+    rand_index = np.random.randint(dim, size=n_envs)
+    probs2 = np.zeros((n_envs, dim))
+    probs2[np.arange(n_envs), rand_index] = 1.0
+    probs = (1 - cov[:, None]) * probs + cov[:, None] * probs2
+
+    # Inverse-CDF sampling of the arm pulled at every step.
+    cdf = np.cumsum(probs, axis=-1)
+    u = np.random.uniform(size=(n_envs, H, 1)) * cdf[:, None, -1:]
+    arms = np.minimum((cdf[:, None, :] <= u).sum(axis=-1), dim - 1)
+
+    arm_means = np.take_along_axis(means, arms, axis=1)
+    if type == 'uniform':
+        rs = arm_means + np.random.normal(size=(n_envs, H)) * var[:, None]
+    elif type == 'bernoulli':
+        rs = np.random.binomial(1, arm_means)
+    else:
+        raise NotImplementedError
+
+    xs = np.ones((n_envs, H, 1), dtype=int)
+    us = np.eye(dim)[arms]
+    xps = np.ones((n_envs, H, 1), dtype=int)
+    return xs, us, xps, rs
 
-    # data generated by thompson sampling policy.
-    prior_mean = 0.0
-    prior_var = 1.0
 
-    thmp = ThompsonSamplingPolicy(
+def rollin_linear_bandit_vec(envs):
+    H = envs[0].H_context
+    means = np.array([env.means for env in envs])
+    var = np.array([env.var for env in envs])
+    n_envs, dim = means.shape
+    rows = np.arange(n_envs)
+
+    # data generated by a linear thompson sampling policy, stepped for all
+    # envs at once.
+    thmp = LinearThompsonSamplingPolicy(
         envs[0],
         std=envs[0].var,
         sample=True,
-        prior_mean=prior_mean,
-        prior_var=prior_var,
-        warm_start=False,
-        batch_size=len(envs)
+        prior_var=1.0,
+        batch_size=n_envs,
     )
 
-    vec_env = bandit_env.BanditEnvVec(envs)
-    _, meta = eval_bandit.deploy_online_vec(vec_env, thmp, H, include_meta=True)
-    context_states = meta['context_states']
-    context_actions = meta['context_actions']
-    context_next_states = meta['context_next_states']
-    context_rewards = meta['context_rewards'][:, :, 0]
+    arms = np.zeros((n_envs, H), dtype=int)
+    rs = np.zeros((n_envs, H))
+    for h in range(H):
+        arms[:, h] = np.argmax(thmp.act_numpy_vec(None), axis=-1)
+        rs[:, h] = means[rows, arms[:, h]] + np.random.normal(0, var)
+        thmp.update(arms[:, h], rs[:, h])
 
-    return context_states, context_actions, context_next_states, context_rewards
+    context_states = np.ones((n_envs, H, 1))
+    context_actions = np.eye(dim)[arms]
+    context_next_states = np.ones((n_envs, H, 1))
+    return context_states, context_actions, context_next_states, rs
 
 
 def rollin_mdp(env, rollin_type):
@@ -111,6 +151,41 @@ def rollin_mdp(env, rollin_type):
     return states, actions, next_states, rewards
 
 
+def rollin_mdp_vec(env, rollin_type):
+    """
+    Batched version of rollin_mdp for a DarkroomEnvBatch.
+    Returns arrays with a leading (n_envs,) dimension.
+    """
+    states = []
+    actions = []
+    next_states = []
+    rewards = []
+
+    state = env.reset()
+    for _ in range(env.horizon):
+        if rollin_type == 'uniform':
+            state = env.sample_state()
+            action = env.sample_action()
+        elif rollin_type == 'expert':
+            action = env.opt_action(state)
+        else:
+            raise NotImplementedError
+        next_state, reward = env.transit(state, action)
+
+        states.append(state)
+        actions.append(action)
+        next_states.append(next_state)
+        rewards.append(reward)
+        state = next_state
+
+    states = np.stack(states, axis=1)
+    actions = np.stack(actions, axis=1)
+    next_states = np.stack(next_states, axis=1)
+    rewards = np.stack(rewards, axis=1)
+
+    return states, actions, next_states, rewards
+
+
 def rand_pos_and_dir(env):
     pos_vec = np.random.uniform(0, env.size, size=3)
     pos_vec[1] = 0.0
@@ -130,7 +205,6 @@ def rollin_mdp_miniworld(env, horizon, rollin_type, target_shape=(25, 25, 3)):
             env.place_agent(pos=init_pos, dir=init_dir)
 
         obs = env.render_obs()
-        obs = resize(obs, target_shape, anti_aliasing=True)
         observations.append(obs)
         pos_and_dirs.append(np.concatenate(
             [env.agent.pos[[0, -1]], env.agent.dir_vec[[0, -1]]]))
@@ -138,6 +212,7 @@ def rollin_mdp_miniworld(env, horizon, rollin_type, target_shape=(25, 25, 3)):
         if rollin_type == 'uniform':
             action = np.random.randint(env.action_space.n)
         elif rollin_type == 'expert':
+            obs = resize_images(obs[None], target_shape)[0]
             action = env.opt_a(obs, env.agent.pos, env.agent.dir_vec)
         else:
             raise ValueError("Invalid rollin type")
@@ -148,7 +223,7 @@ def rollin_mdp_miniworld(env, horizon, rollin_type, target_shape=(25, 25, 3)):
         actions.append(a_zero)
         rewards.append(rew)
 
-    observations = np.array(observations)
+    observations = resize_images(np.array(observations), target_shape)
     states = np.array(pos_and_dirs)[..., 2:]    # only use dir, not pos
     actions = np.array(actions)
     rewards = np.array(rewards)
@@ -156,15 +231,22 @@ def rollin_mdp_miniworld(env, horizon, rollin_type, target_shape=(25, 25, 3)):
 
 
 def generate_bandit_histories_from_envs(envs, n_hists, n_samples, cov, type):
+    means = np.array([env.means for env in envs])
+    var = np.array([env.var for env in envs])
+    rollins = [
+        rollin_bandit_vec(means, envs[0].H_context, var, type=envs[0].type)
+        for _ in range(n_hists)
+    ]
+
     trajs = []
-    for env in envs:
+    for i, env in enumerate(envs):
         for j in range(n_hists):
             (
                 context_states,
                 context_actions,
                 context_next_states,
                 context_rewards,
-            ) = rollin_bandit(env, cov=cov)
+            ) = (x[i] for x in rollins[j])
             for k in range(n_samples):
                 query_state = np.array([1])
                 optimal_action = env.opt_a
@@ -187,32 +269,42 @@ def generate_bandit_histories_from_envs(envs, n_hists, n_samples, cov, type):
 
 
 def generate_mdp_histories_from_envs(envs, n_hists, n_samples, rollin_type):
+    if not isinstance(envs, darkroom_env.DarkroomEnvBatch):
+        envs = darkroom_env.DarkroomEnvBatch.from_envs(envs)
+
+    rollins = [rollin_mdp_vec(envs, rollin_type=rollin_type)
+               for _ in range(n_hists)]
+    query_states = np.stack([
+        np.stack([envs.sample_state() for _ in range(n_samples)], axis=1)
+        for _ in range(n_hists)], axis=1)
+    optimal_actions = np.stack([
+        np.stack([envs.opt_action(query_states[:, j, k])
+                  for k in range(n_samples)], axis=1)
+        for j in range(n_hists)], axis=1)
+
     trajs = []
-    for env in envs:
+    for i in range(envs.num_envs):
         for j in range(n_hists):
             (
                 context_states,
                 context_actions,
                 context_next_states,
                 context_rewards,
-            ) = rollin_mdp(env, rollin_type=rollin_type)
+            ) = (x[i] for x in rollins[j])
             for k in range(n_samples):
-                query_state = env.sample_state()
-                optimal_action = env.opt_action(query_state)
-
                 traj = {
-                    'query_state': query_state,
-                    'optimal_action': optimal_action,
+                    'query_state': query_states[i, j, k],
+                    'optimal_action': optimal_actions[i, j, k],
                     'context_states': context_states,
                     'context_actions': context_actions,
                     'context_next_states': context_next_states,
                     'context_rewards': context_rewards,
-                    'goal': env.goal,
+                    'goal': envs.goals[i],
                 }
 
                 # Add perm_index for DarkroomEnvPermuted
-                if hasattr(env, 'perm_index'):
-                    traj['perm_index'] = env.perm_index
+                if envs.perm_indices is not None:
+                    traj['perm_index'] = envs.perm_indices[i]
 
                 trajs.append(traj)
     return trajs
@@ -225,7 +317,7 @@ def generate_bandit_histories(n_envs, dim, horizon, var, **kwargs):
     return trajs
 
 
-def generate_linear_bandit_histories(n_envs, dim, lin_d, horizon, var, **kwargs):
+def generate_linear_bandit_histories(n_envs, dim, lin_d, horizon, var, n_hists, n_samples, **kwargs):
     # generate fixed features for arms of all linear bandits
     rng = np.random.RandomState(seed=1234)
     arms = rng.normal(size=(dim, lin_d)) / np.sqrt(lin_d)
@@ -288,21 +380,31 @@ def generate_linear_bandit_histories(n_envs, dim, lin_d, horizon, var, **kwargs)
 
 
 def generate_darkroom_histories(goals, dim, horizon, **kwargs):
-    envs = [darkroom_env.DarkroomEnv(dim, goal, horizon) for goal in goals]
+    envs = darkroom_env.DarkroomEnvBatch(dim, goals, horizon)
     trajs = generate_mdp_histories_from_envs(envs, **kwargs)
     return trajs
 
 
+def darkroom_heldout_goals(dim):
+    """
+    Splits the goals of a dim x dim darkroom into train and held-out goals.
+    """
+    goals = np.array([[(j, i) for i in range(dim)]
+                     for j in range(dim)]).reshape(-1, 2)
+    np.random.RandomState(seed=0).shuffle(goals)
+    train_test_split = int(.8 * len(goals))
+    return goals[:train_test_split], goals[train_test_split:]
+
+
 def generate_darkroom_permuted_histories(indices, dim, horizon, **kwargs):
-    envs = [darkroom_env.DarkroomEnvPermuted(
-        dim, index, horizon) for index in indices]
+    envs = darkroom_env.DarkroomEnvBatch.permuted(dim, indices, horizon)
     trajs = generate_mdp_histories_from_envs(envs, **kwargs)
     return trajs
 
 
-def generate_miniworld_histories(env_ids, image_dir, n_hists, n_samples, horizon, target_shape, rollin_type='uniform'):
-    if not os.path.exists(image_dir):
-        os.makedirs(image_dir, exist_ok=True)
+def generate_miniworld_histories(env_ids, n_hists, n_samples, horizon, target_shape, rollin_type='uniform'):
+    import gymnasium as gym
+    import miniworld
 
     n_envs = len(env_ids)
     env = gym.make('MiniWorld-OneRoomS6FastMultiFourBoxesFixedInit-v0')
@@ -320,14 +422,14 @@ def generate_miniworld_histories(env_ids, image_dir, n_hists, n_samples, horizon
                 context_actions,
                 context_rewards,
             ) = rollin_mdp_miniworld(env, horizon, rollin_type=rollin_type, target_shape=target_shape)
-            filepath = f'{image_dir}/context{i}_{j}.npy'
-            np.save(filepath, context_images)
+            # Stored as uint8 in one memory-mapped array per dataset.
+            context_images = np.round(context_images * 255).astype(np.uint8)
 
             for _ in range(n_samples):
                 init_pos, init_dir = rand_pos_and_dir(env)
                 env.place_agent(pos=init_pos, dir=init_dir)
                 obs = env.render_obs()
-                obs = resize(obs, target_shape, anti_aliasing=True)
+                obs = resize_images(obs[None], target_shape)[0]
 
                 action = env.opt_a(obs, env.agent.pos, env.agent.dir_vec)
                 one_hot_action = np.zeros(env.action_space.n)
@@ -337,7 +439,7 @@ def generate_miniworld_histories(env_ids, image_dir, n_hists, n_samples, horizon
                     'query_image': obs,
                     'query_state': env.agent.dir_vec[[0, -1]], # only use dir, not pos
                     'optimal_action': one_hot_action,
-                    'context_images': filepath,
+                    'context_images': context_images,
                     'context_states': context_states,
                     'context_actions': context_actions,
                     'context_next_states': context_states,  # unused
@@ -348,28 +450,112 @@ def generate_miniworld_histories(env_ids, image_dir, n_hists, n_samples, horizon
     return trajs
 
 
-if __name__ == '__main__':
-    np.random.seed(0)
-    random.seed(0)
+def _generate_shard(args):
+    generate_fn, shard, seed, kwargs = args
+    np.random.seed(seed)
+    random.seed(seed)
+    return generate_fn(shard, **kwargs)
+
+
+def _chunk_seed(seed, chunk):
+    return int(np.random.SeedSequence(seed, spawn_key=(chunk,)).generate_state(1)[0])
+
+
+def write_histories(filepath, generate_fn, envs, n_workers, chunk_size, key, meta=None, **kwargs):
+    """
+    Runs generate_fn(chunk, **kwargs) over chunks of at most chunk_size envs
+    and streams each chunk to the columnar dataset at filepath, so memory
+    stays bounded by n_workers chunks. envs is either a number of envs to
+    sample or an array of goals/env ids. Each chunk gets its own RNG stream
+    derived from the global numpy seed and its index, which makes the output
+    independent of n_workers.
+
+    Chunks are tagged with the dataset key (see registry.py). Chunks already
+    at filepath with matching tags are kept, which resumes interrupted runs
+    and makes an identical rerun a no-op. Missing chunks are copied from
+    the registered dataset with the same key that shares the most of them,
+    e.g. a smaller dataset being extended with more envs, and only the rest
+    is generated.
+    """
+    if np.isscalar(envs):
+        chunks = [min(chunk_size, envs - start)
+                  for start in range(0, envs, chunk_size)]
+    else:
+        chunks = [envs[start:start + chunk_size]
+                  for start in range(0, len(envs), chunk_size)]
+    seed = np.random.randint(2**31)
+    tags = registry.chunk_tags(key, chunks)
+    path = columnar_path(filepath)
+
+    writer = ColumnarWriter(filepath, meta=dict(meta or {}, key=key, chunk_size=chunk_size))
+    writer.truncate_chunks(registry.common_prefix(writer.tags, tags))
+    if writer.n_chunks == len(chunks):
+        print(f"Found {path} in the dataset registry, skipping generation.")
+        writer.close()
+        return
+    if writer.n_chunks > 0:
+        print(f"Resuming {path} at chunk {writer.n_chunks}/{len(chunks)}")
+
+    source, n_shared = registry.best_source(key, tags)
+    if n_shared > writer.n_chunks:
+        print(f"Copying chunks {writer.n_chunks}-{n_shared} of {len(chunks)} from {source}")
+        writer.copy_chunks(source, writer.n_chunks, n_shared)
+
+    n_workers = max(1, n_workers)
+    pool = mp.Pool(n_workers) if n_workers > 1 else None
+    # Chunks generated in this process reseed the global RNGs. Restore them
+    # afterwards so the seeds of later splits do not depend on n_workers or
+    # on which chunks were reused.
+    rng_states = np.random.get_state(), random.getstate()
+    try:
+        for start in range(writer.n_chunks, len(chunks), n_workers):
+            indices = range(start, min(start + n_workers, len(chunks)))
+            args = [(generate_fn, chunks[c], _chunk_seed(seed, c), kwargs)
+                    for c in indices]
+            results = pool.imap(_generate_shard, args) if pool else map(_generate_shard, args)
+            for c, trajs in zip(indices, results):
+                writer.append(trajs_to_columns(trajs), tag=tags[c])
+            print(f"Wrote chunk {writer.n_chunks}/{len(chunks)} of {path}")
+    finally:
+        if pool is not None:
+            pool.terminate()
+        np.random.set_state(rng_states[0])
+        random.setstate(rng_states[1])
+    writer.close()
+
 
+if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     common_args.add_dataset_args(parser)
+    parser.add_argument("--workers", type=int, required=False,
+                        default=1, help="Number of data collection processes")
+    parser.add_argument("--chunk_size", type=int, required=False,
+                        default=1000, help="Envs generated and written per chunk")
+    parser.add_argument("--seed", type=int, required=False,
+                        default=0, help="Data generation seed")
     args = vars(parser.parse_args())
     print("Args: ", args)
 
+    seed = args['seed']
+    np.random.seed(seed)
+    random.seed(seed)
+
     env = args['env']
     n_envs = args['envs']
     n_eval_envs = args['envs_eval']
     n_hists = args['hists']
     n_samples = args['samples']
     horizon = args['H']
+    if isinstance(horizon, list):
+        horizon = horizon[0]    # several context sizes are only used by eval.py
     dim = args['dim']
     var = args['var']
     cov = args['cov']
     env_id_start = args['env_id_start']
     env_id_end = args['env_id_end']
     lin_d = args['lin_d']
-
+    n_workers = args['workers']
+    chunk_size = args['chunk_size']
 
     n_train_envs = int(.8 * n_envs)
     n_test_envs = n_envs - n_train_envs
@@ -380,58 +566,77 @@ if __name__ == '__main__':
         'horizon': horizon,
     }
 
+    def dataset_key(mode):
+        return registry.dataset_key(env, mode, config, seed, chunk_size)
+
+    if not os.path.exists('datasets'):
+        os.makedirs('datasets', exist_ok=True)
+
     if env == 'bandit':
         config.update({'dim': dim, 'var': var, 'cov': cov, 'type': 'uniform'})
 
-        train_trajs = generate_bandit_histories(n_train_envs, **config)
-        test_trajs = generate_bandit_histories(n_test_envs, **config)
-        eval_trajs = generate_bandit_histories(n_eval_envs, **config)
-
         train_filepath = build_bandit_data_filename(env, n_envs, config, mode=0)
         test_filepath = build_bandit_data_filename(env, n_envs, config, mode=1)
         eval_filepath = build_bandit_data_filename(env, n_eval_envs, config, mode=2)
+        meta = {'env': env, 'config': config}
+
+        write_histories(train_filepath, generate_bandit_histories,
+                        n_train_envs, n_workers, chunk_size,
+                        dataset_key(0), dict(meta, mode=0, seed=seed), **config)
+        write_histories(test_filepath, generate_bandit_histories,
+                        n_test_envs, n_workers, chunk_size,
+                        dataset_key(1), dict(meta, mode=1, seed=seed), **config)
+        write_histories(eval_filepath, generate_bandit_histories,
+                        n_eval_envs, n_workers, chunk_size,
+                        dataset_key(2), dict(meta, mode=2, seed=seed), **config)
 
     elif env == 'linear_bandit':
         config.update({'dim': dim, 'lin_d': lin_d, 'var': var, 'cov': cov, 'data_type': 'thompson'})
 
-        train_trajs = generate_linear_bandit_histories(n_train_envs, **config)
-        test_trajs = generate_linear_bandit_histories(n_test_envs, **config)
-        eval_trajs = generate_linear_bandit_histories(n_eval_envs, **config)
-
         train_filepath = build_linear_bandit_data_filename(env, n_envs, config, mode=0)
         test_filepath = build_linear_bandit_data_filename(env, n_envs, config, mode=1)
         eval_filepath = build_linear_bandit_data_filename(env, n_eval_envs, config, mode=2)
+        meta = {'env': env, 'config': config}
+
+        write_histories(train_filepath, generate_linear_bandit_histories,
+                        n_train_envs, n_workers, chunk_size,
+                        dataset_key(0), dict(meta, mode=0, seed=seed), **config)
+        write_histories(test_filepath, generate_linear_bandit_histories,
+                        n_test_envs, n_workers, chunk_size,
+                        dataset_key(1), dict(meta, mode=1, seed=seed), **config)
+        write_histories(eval_filepath, generate_linear_bandit_histories,
+                        n_eval_envs, n_workers, chunk_size,
+                        dataset_key(2), dict(meta, mode=2, seed=seed), **config)
 
     elif env == 'darkroom_heldout':
 
         config.update({'dim': dim, 'rollin_type': 'uniform'})
-        goals = np.array([[(j, i) for i in range(dim)]
-                         for j in range(dim)]).reshape(-1, 2)
-        np.random.RandomState(seed=0).shuffle(goals)
-        train_test_split = int(.8 * len(goals))
-        train_goals = goals[:train_test_split]
-        test_goals = goals[train_test_split:]
+        train_goals, test_goals = darkroom_heldout_goals(dim)
 
         eval_goals = np.array(test_goals.tolist() *
                               int(100 // len(test_goals)))
         train_goals = np.repeat(train_goals, n_envs // (dim * dim), axis=0)
         test_goals = np.repeat(test_goals, n_envs // (dim * dim), axis=0)
 
-        train_trajs = generate_darkroom_histories(train_goals, **config)
-        test_trajs = generate_darkroom_histories(test_goals, **config)
-        eval_trajs = generate_darkroom_histories(eval_goals, **config)
-
         train_filepath = build_darkroom_data_filename(
             env, n_envs, config, mode=0)
         test_filepath = build_darkroom_data_filename(
             env, n_envs, config, mode=1)
         eval_filepath = build_darkroom_data_filename(env, 100, config, mode=2)
+        meta = {'env': env, 'config': config}
 
+        write_histories(train_filepath, generate_darkroom_histories,
+                        train_goals, n_workers, chunk_size,
+                        dataset_key(0), dict(meta, mode=0, seed=seed), **config)
+        write_histories(test_filepath, generate_darkroom_histories,
+                        test_goals, n_workers, chunk_size,
+                        dataset_key(1), dict(meta, mode=1, seed=seed), **config)
+        write_histories(eval_filepath, generate_darkroom_histories,
+                        eval_goals, n_workers, chunk_size,
+                        dataset_key(2), dict(meta, mode=2, seed=seed), **config)
 
-    elif env == 'miniworld':
-        import gymnasium as gym
-        import miniworld
 
+    elif env == 'miniworld':
         config.update({'rollin_type': 'uniform', 
             'target_shape': (25, 25, 3),
         })
@@ -441,8 +646,9 @@ if __name__ == '__main__':
             env_id_end = n_envs
 
         # make sure you don't just generate the same data when batching data collection
-        np.random.seed(0 + env_id_start)    
-        random.seed(0 + env_id_start)       
+        seed = seed + env_id_start
+        np.random.seed(seed)
+        random.seed(seed)
 
 
         env_ids = np.arange(env_id_start, env_id_end)
@@ -456,34 +662,40 @@ if __name__ == '__main__':
         test_filepath = build_miniworld_data_filename(
             env, env_id_start, env_id_end, config, mode=1)
         eval_filepath = build_miniworld_data_filename(env, 0, 100, config, mode=2)
+        meta = {'env': env, 'config': config}
 
 
-        train_trajs = generate_miniworld_histories(
+        write_histories(
+            train_filepath,
+            generate_miniworld_histories,
             train_env_ids,
-            train_filepath.split('.')[0],
+            n_workers,
+            chunk_size,
+            dataset_key(0),
+            dict(meta, mode=0, seed=seed),
             **config)
-        test_trajs = generate_miniworld_histories(
+        write_histories(
+            test_filepath,
+            generate_miniworld_histories,
             test_env_ids,
-            test_filepath.split('.')[0],
+            n_workers,
+            chunk_size,
+            dataset_key(1),
+            dict(meta, mode=1, seed=seed),
             **config)
-        eval_trajs = generate_miniworld_histories(
+        write_histories(
+            eval_filepath,
+            generate_miniworld_histories,
             test_env_ids[:100],
-            eval_filepath.split('.')[0],
+            n_workers,
+            chunk_size,
+            dataset_key(2),
+            dict(meta, mode=2, seed=seed),
             **config)
 
     else:
         raise NotImplementedError
 
-
-    if not os.path.exists('datasets'):
-        os.makedirs('datasets', exist_ok=True)
-    with open(train_filepath, 'wb') as file:
-        pickle.dump(train_trajs, file)
-    with open(test_filepath, 'wb') as file:
-        pickle.dump(test_trajs, file)
-    with open(eval_filepath, 'wb') as file:
-        pickle.dump(eval_trajs, file)
-
-    print(f"Saved to {train_filepath}.")
-    print(f"Saved to {test_filepath}.")
-    print(f"Saved to {eval_filepath}.")
+    print(f"Saved to {columnar_path(train_filepath)}.")
+    print(f"Saved to {columnar_path(test_filepath)}.")
+    print(f"Saved to {columnar_path(eval_filepath)}.")
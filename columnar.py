@@ -0,0 +1,366 @@
+import argparse
+import json
+import os
+import pickle
+import struct
+
+import numpy as np
+
+FORMAT_VERSION = 2
+
+# Fields stored once per query sample. Every other field (the context
+# arrays and per-env metadata) is stored once per context, and
+# 'context_index' maps each query to the row of its context.
+QUERY_FIELDS = ('query_state', 'optimal_action', 'query_image', 'context_index')
+
+
+def columnar_path(path):
+    """
+    Maps a 'datasets/trajs_*.pkl' filename to the directory holding the
+    columnar version of the same dataset.
+    """
+    if path.endswith('.pkl'):
+        return path[:-len('.pkl')]
+    return path
+
+
+def is_columnar(path):
+    return os.path.isfile(os.path.join(columnar_path(path), 'header.json'))
+
+
+def dataset_exists(path):
+    return is_columnar(path) or os.path.isfile(path)
+
+
+def _same_context(traj, other, context_keys):
+    return all(
+        traj[key] is other[key] or np.array_equal(traj[key], other[key])
+        for key in context_keys)
+
+
+def trajs_to_columns(trajs):
+    """
+    Stacks a list of trajectory dicts into one contiguous array per field.
+    Consecutive trajectories that share their context (the n_samples
+    queries of one history) store it only once.
+    """
+    context_keys = [key for key in trajs[0] if key not in QUERY_FIELDS]
+    query_keys = [key for key in trajs[0] if key in QUERY_FIELDS]
+
+    contexts = []
+    context_index = []
+    for traj in trajs:
+        if not contexts or not _same_context(traj, contexts[-1], context_keys):
+            contexts.append(traj)
+        context_index.append(len(contexts) - 1)
+
+    columns = {key: np.array([traj[key] for traj in contexts])
+               for key in context_keys}
+    columns.update({key: np.array([traj[key] for traj in trajs])
+                    for key in query_keys})
+    columns['context_index'] = np.array(context_index, dtype=np.int64)
+    return columns
+
+
+def columns_to_trajs(columns):
+    """
+    Splits columns back into a list of trajectory dicts (views, no copies).
+    """
+    context_index = columns['context_index']
+    trajs = []
+    for i, c in enumerate(context_index):
+        traj = {key: value[c] for key, value in columns.items()
+                if key not in QUERY_FIELDS}
+        traj.update({key: value[i] for key, value in columns.items()
+                     if key in QUERY_FIELDS and key != 'context_index'})
+        trajs.append(traj)
+    return trajs
+
+
+# Fields are written as .npy files with a fixed-size header so that rows can
+# be appended in place and the header rewritten with the new row count.
+_NPY_HEADER_SIZE = 256
+
+
+def _write_npy_header(f, dtype, shape):
+    header = repr({
+        'descr': np.lib.format.dtype_to_descr(dtype),
+        'fortran_order': False,
+        'shape': tuple(shape),
+    })
+    # magic (6) + version (2) + header length (2) + header + newline
+    header = header.ljust(_NPY_HEADER_SIZE - 11) + '\n'
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)))
+    f.write(header.encode('latin1'))
+
+
+def _write_json(filepath, obj):
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_filepath, filepath)
+
+
+def _as_json(obj):
+    return json.loads(json.dumps(obj))
+
+
+class ColumnarWriter:
+    """
+    Streams chunks of columns into a columnar dataset, so that a dataset
+    never has to be held in memory as a whole. Every appended chunk is
+    flushed to disk and recorded in progress.json. Opening a writer on a
+    directory with a matching progress.json (or a complete dataset with the
+    same meta) reopens it after its last complete chunk. close() writes
+    header.json and marks the dataset complete.
+
+    Chunks can carry a tag identifying what they were generated from, so
+    callers can keep the chunks that are still valid with truncate_chunks()
+    and take over chunks of other datasets with copy_chunks().
+    """
+
+    def __init__(self, path, meta=None, resume=True):
+        self.path = columnar_path(path)
+        self.meta = _as_json(meta or {})
+        self.progress_filepath = os.path.join(self.path, 'progress.json')
+        header_filepath = os.path.join(self.path, 'header.json')
+        os.makedirs(self.path, exist_ok=True)
+
+        state = None
+        for filepath in (self.progress_filepath, header_filepath):
+            if resume and state is None and os.path.isfile(filepath):
+                with open(filepath) as f:
+                    state = json.load(f)
+                if state['meta'] != self.meta or 'chunks' not in state:
+                    print(f"Not reusing {filepath}: config changed.")
+                    state = None
+
+        if state is None:
+            self.fields = {}
+            self.chunks = []
+        else:
+            self.fields = state['fields']
+            self.chunks = state['chunks']
+            self._truncate()
+            # Record the reopened chunks before header.json goes, so a run
+            # stopped from here on still resumes after them.
+            self._write_progress()
+
+        if os.path.isfile(header_filepath):
+            os.remove(header_filepath)
+
+    @property
+    def n_chunks(self):
+        return len(self.chunks)
+
+    @property
+    def n_contexts(self):
+        return self.chunks[-1]['n_contexts'] if self.chunks else 0
+
+    @property
+    def n_queries(self):
+        return self.chunks[-1]['n_queries'] if self.chunks else 0
+
+    @property
+    def tags(self):
+        return [chunk['tag'] for chunk in self.chunks]
+
+    def _filepath(self, key):
+        return os.path.join(self.path, f'{key}.npy')
+
+    def _truncate(self):
+        # Drop rows past the last recorded chunk, e.g. of a chunk that was
+        # being written when a run stopped.
+        for key, field in self.fields.items():
+            field['shape'][0] = self.n_queries if key in QUERY_FIELDS else self.n_contexts
+            dtype = np.dtype(field['dtype'])
+            n_bytes = dtype.itemsize * int(np.prod(field['shape']))
+            with open(self._filepath(key), 'r+b') as f:
+                f.truncate(_NPY_HEADER_SIZE + n_bytes)
+                _write_npy_header(f, dtype, field['shape'])
+
+    def _write_progress(self):
+        _write_json(self.progress_filepath, {
+            'n_chunks': self.n_chunks,
+            'n_contexts': self.n_contexts,
+            'n_queries': self.n_queries,
+            'fields': self.fields,
+            'chunks': self.chunks,
+            'meta': self.meta,
+        })
+
+    def truncate_chunks(self, n_chunks):
+        if n_chunks < self.n_chunks:
+            self.chunks = self.chunks[:n_chunks]
+            self._truncate()
+            self._write_progress()
+
+    def append(self, columns, tag=None):
+        n_contexts = len(columns['context_states'])
+        n_queries = len(columns['context_index'])
+        columns = dict(columns)
+        columns['context_index'] = columns['context_index'] + self.n_contexts
+        if self.fields:
+            assert set(columns) == set(self.fields), \
+                f"Chunk fields {sorted(columns)} differ from {sorted(self.fields)}"
+
+        for key, value in columns.items():
+            value = np.asarray(value)
+            n_rows = n_queries if key in QUERY_FIELDS else n_contexts
+            assert len(value) == n_rows, f"Field {key} has {len(value)} rows"
+
+            if key not in self.fields:
+                dtype = value.dtype
+                if dtype.kind == 'U':
+                    # Leave room for longer strings in later chunks.
+                    dtype = np.dtype(f'<U{max(dtype.itemsize // 4, 256)}')
+                self.fields[key] = {
+                    'dtype': dtype.str, 'shape': [0] + list(value.shape[1:])}
+                with open(self._filepath(key), 'wb') as f:
+                    _write_npy_header(f, dtype, self.fields[key]['shape'])
+
+            field = self.fields[key]
+            assert list(value.shape[1:]) == field['shape'][1:], \
+                f"Field {key} has shape {value.shape[1:]}"
+            dtype = np.dtype(field['dtype'])
+            with open(self._filepath(key), 'r+b') as f:
+                f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(value, dtype=dtype).tobytes())
+                field['shape'][0] += n_rows
+                _write_npy_header(f, dtype, field['shape'])
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.chunks.append({
+            'n_contexts': self.n_contexts + n_contexts,
+            'n_queries': self.n_queries + n_queries,
+            'tag': tag,
+        })
+        self._write_progress()
+
+    def copy_chunks(self, path, start, stop):
+        """
+        Appends chunks [start, stop) of the complete dataset at path, one
+        chunk at a time from memory-mapped fields.
+        """
+        columns, header = load_columns(path, mmap_mode='r')
+        bounds = [{'n_contexts': 0, 'n_queries': 0}] + header['chunks']
+        for c in range(start, stop):
+            c0, c1 = bounds[c]['n_contexts'], bounds[c + 1]['n_contexts']
+            q0, q1 = bounds[c]['n_queries'], bounds[c + 1]['n_queries']
+            chunk = {key: value[q0:q1] if key in QUERY_FIELDS else value[c0:c1]
+                     for key, value in columns.items()}
+            chunk['context_index'] = chunk['context_index'] - c0
+            self.append(chunk, tag=header['chunks'][c]['tag'])
+
+    def close(self):
+        _write_json(os.path.join(self.path, 'header.json'), {
+            'version': FORMAT_VERSION,
+            'n_contexts': self.n_contexts,
+            'n_queries': self.n_queries,
+            'fields': self.fields,
+            'chunks': self.chunks,
+            'meta': self.meta,
+        })
+        if os.path.isfile(self.progress_filepath):
+            os.remove(self.progress_filepath)
+
+
+def save_columns(path, columns, meta=None):
+    """
+    Writes a dataset as a directory with one .npy file per field and a
+    header.json describing the fields. Query fields hold one row per query
+    and all other fields one row per context. The header is written last, so a
+    directory without one is an incomplete dataset.
+    """
+    writer = ColumnarWriter(path, meta=meta, resume=False)
+    writer.append(columns)
+    writer.close()
+
+
+def load_header(path):
+    with open(os.path.join(columnar_path(path), 'header.json')) as f:
+        return json.load(f)
+
+
+def load_columns(path, mmap_mode=None):
+    """
+    Loads the fields of a columnar dataset. Returns (columns, header).
+    """
+    path = columnar_path(path)
+    header = load_header(path)
+    columns = {
+        key: np.load(os.path.join(path, f'{key}.npy'), mmap_mode=mmap_mode)
+        for key in header['fields']
+    }
+    if 'context_index' not in columns:
+        # Version 1 stored one context per query.
+        columns['context_index'] = np.arange(header['n_samples'])
+    return columns, header
+
+
+def concat_columns(columns_list, exclude=()):
+    """
+    Concatenates the columns of several datasets, offsetting context_index.
+    Fields in exclude are left out, e.g. to keep them memory-mapped per
+    dataset instead of copying them into one array.
+    """
+    offsets = np.cumsum([0] + [len(c['context_states']) for c in columns_list])
+    columns = {
+        key: np.concatenate([c[key] for c in columns_list])
+        for key in columns_list[0]
+        if key != 'context_index' and key not in exclude
+    }
+    columns['context_index'] = np.concatenate([
+        c['context_index'] + offset
+        for c, offset in zip(columns_list, offsets)])
+    return columns
+
+
+def save_trajs(path, trajs, meta=None):
+    save_columns(path, trajs_to_columns(trajs), meta=meta)
+
+
+def load_trajs(path):
+    """
+    Loads a dataset as a list of trajectory dicts from either the columnar
+    format or a legacy pickle.
+    """
+    if is_columnar(path):
+        columns, _ = load_columns(path)
+        return columns_to_trajs(columns)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_dataset_columns(path, mmap_mode=None):
+    """
+    Loads a dataset as columns from either the columnar format or a legacy
+    pickle.
+    """
+    if is_columnar(path):
+        columns, _ = load_columns(path, mmap_mode=mmap_mode)
+        return columns
+    with open(path, 'rb') as f:
+        return trajs_to_columns(pickle.load(f))
+
+
+def convert(path):
+    """
+    Converts a legacy list-of-dicts pickle into the columnar format.
+    """
+    with open(path, 'rb') as f:
+        trajs = pickle.load(f)
+    save_trajs(path, trajs, meta={'converted_from': os.path.basename(path)})
+    return columnar_path(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert trajs_*.pkl datasets to the columnar format")
+    parser.add_argument("paths", type=str, nargs='+', help="Pickle files")
+    args = vars(parser.parse_args())
+
+    for path in args['paths']:
+        print(f"Converted {path} to {convert(path)}.")
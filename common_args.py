@@ -39,11 +39,34 @@ def add_model_args(parser):
     parser.add_argument("--dropout", type=float,
                         required=False, default=0, help="Dropout")
     parser.add_argument('--shuffle', default=False, action='store_true')
+    parser.add_argument('--backbone', type=str, default='gpt2',
+                        choices=['gpt2', 'native'],
+                        help="Transformer backbone: HuggingFace GPT2Model or the built-in one")
+    parser.add_argument('--layout', type=str, default='query_first',
+                        choices=['query_first', 'context_first'],
+                        help="Token order: query before the context, or queries appended "
+                             "after it so the context is encoded once (native backbone only)")
+    parser.add_argument('--precision', type=str, default='fp32',
+                        choices=['fp32', 'bf16'],
+                        help="Run the transformer under bfloat16 autocast, for training "
+                             "(with float32 weights) and the evaluated controllers")
+    parser.add_argument('--procedural', default=False, action='store_true',
+                        help="Train on tasks sampled on the fly instead of loading datasets "
+                             "(bandits, darkroom)")
 
 
 def add_train_args(parser):
     parser.add_argument("--num_epochs", type=int, required=False,
                         default=1000, help="Number of epochs")
+    parser.add_argument('--per_sample_shuffle', default=False, action='store_true',
+                        help="With --shuffle, permute contexts per sample instead of per batch")
+    parser.add_argument('--image_cache', type=str, default='float16',
+                        choices=['float16', 'uint8', 'none'],
+                        help="Preprocessed context image cache (for miniworld)")
+    parser.add_argument('--data_workers', type=int, default=0,
+                        help="DataLoader workers generating procedural data")
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help="Batches prepared ahead on a background thread (0 disables)")
 
 
 def add_eval_args(parser):
@@ -57,3 +80,14 @@ def add_eval_args(parser):
     parser.add_argument("--n_eval", type=int, required=False,
                         default=100, help="Number of eval trajectories")
     parser.add_argument("--save_video", default=False, action='store_true')
+    parser.add_argument("--eval_workers", type=int, required=False,
+                        default=1, help="Number of env processes (for miniworld)")
+    parser.add_argument("--kv_cache", type=str, default='auto', choices=['auto', 'on', 'off'],
+                        help="Run online contexts incrementally through a KV cache; auto uses "
+                             "it for bandits and for context_first darkroom and miniworld models")
+    parser.add_argument("--kv_evict", default=False, action='store_true',
+                        help="Once online contexts exceed H, evict the oldest cached "
+                             "transition instead of re-encoding the window (for bandit)")
+    parser.add_argument("--traced", default=False, action='store_true',
+                        help="Run controller predictions through TorchScript traces cached "
+                             "per batch size and context length bucket (fp32 only)")
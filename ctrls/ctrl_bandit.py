@@ -5,6 +5,8 @@ import scipy
 import torch
 from IPython import embed
 
+from utils import autocast
+
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
@@ -19,6 +21,41 @@ class Controller:
         self.env = env
 
 
+class TransformerController(Controller):
+    """
+    Base for the controllers acting with a trained transformer; subclasses
+    build the batch and turn predictions into actions. precision defaults
+    to the model config's. With kv_cache=True the context is run
+    incrementally through a KVCache, with evict passed on to it. That pays
+    off when the query stays the same between steps, as in the bandits,
+    and otherwise only for models with the context_first layout. With
+    traced=True (default: the model config's) uncached predictions run
+    through a TracedPredictor; traces run in float32 only, so not for bf16.
+    """
+    def __init__(self, model, kv_cache=False, evict=False, precision=None, traced=None):
+        self.model = model
+        self.precision = precision or model.config.get('precision', 'fp32')
+        if traced is None:
+            traced = model.config.get('traced', False)
+        self.traced = None
+        if traced and self.precision == 'fp32':
+            # Imported here so that data collection does not load the model.
+            from net import TracedPredictor
+            self.traced = TracedPredictor(model)
+        self.kv_cache = None
+        if kv_cache:
+            from net import KVCache
+            self.kv_cache = KVCache(model, evict=evict)
+
+    def predict(self):
+        with autocast(self.precision):
+            if self.kv_cache is not None:
+                return self.kv_cache(self.batch).float()
+            if self.traced is not None:
+                return self.traced(self.batch)
+            return self.model(self.batch).float()
+
+
 class OptPolicy(Controller):
     def __init__(self, env, batch_size=1):
         super().__init__()
@@ -252,6 +289,85 @@ class ThompsonSamplingPolicy(Controller):
 
 
 
+class LinearThompsonSamplingPolicy(Controller):
+    """
+    Thompson sampling for linear bandits over batch_size envs at once. Each
+    env keeps a Gaussian posterior over theta whose (N, d, d) covariance is
+    updated with one Sherman-Morrison rank-1 step per observation, so a step
+    costs O(d^2) per env instead of refitting on the whole context.
+    """
+    def __init__(self, env, std=.1, sample=True, prior_var=1.0, batch_size=1):
+        super().__init__()
+        self.env = env
+        self.arms = env.arms
+        self.d = self.arms.shape[1]
+        self.dim = env.dim
+        # Keep the posterior mean defined for noiseless bandits.
+        self.variance = max(std**2, 1e-8)
+        self.prior_var = prior_var
+        self.sample = sample
+        self.batch_size = batch_size
+        self.reset()
+
+    def reset(self):
+        self.cov = np.tile(self.prior_var * np.eye(self.d), (self.batch_size, 1, 1))
+        self.b = np.zeros((self.batch_size, self.d))
+        self.last_action = None
+        self.last_reward = None
+        self.n_seen = 0
+
+    @property
+    def theta(self):
+        return np.einsum('nij,nj->ni', self.cov, self.b)
+
+    def update(self, action_indices, rewards):
+        x = self.arms[action_indices]
+        cx = np.einsum('nij,nj->ni', self.cov, x)
+        denom = self.variance + np.einsum('ni,ni->n', x, cx)
+        self.cov -= cx[:, :, None] * cx[:, None, :] / denom[:, None, None]
+        self.cov = 0.5 * (self.cov + self.cov.transpose(0, 2, 1))
+        self.b += x * rewards[:, None] / self.variance
+        self.last_action = action_indices
+        self.last_reward = rewards
+        self.n_seen += 1
+
+    def set_batch(self, batch):
+        self.set_batch_numpy_vec({
+            key: value.cpu().detach().numpy() for key, value in batch.items()})
+
+    def set_batch_numpy_vec(self, batch):
+        self.batch = batch
+        actions = np.argmax(batch['context_actions'], axis=-1)
+        rewards = batch['context_rewards'][:, :, 0]
+
+        # Contexts usually grow by one step between calls, so only the new
+        # rows are folded in. A shorter or shifted context is refit.
+        n_seen = self.n_seen
+        if n_seen > actions.shape[1] or (n_seen > 0 and not (
+                np.array_equal(actions[:, n_seen - 1], self.last_action)
+                and np.array_equal(rewards[:, n_seen - 1], self.last_reward))):
+            self.reset()
+        for t in range(self.n_seen, actions.shape[1]):
+            self.update(actions[:, t], rewards[:, t])
+
+    def act(self, x):
+        return self.act_numpy_vec(x)[0]
+
+    def act_numpy_vec(self, x):
+        theta = self.theta
+        if self.sample:
+            chol = np.linalg.cholesky(self.cov)
+            noise = np.random.normal(size=theta.shape)
+            theta = theta + np.einsum('nij,nj->ni', chol, noise)
+        values = theta @ self.arms.T
+        action_indices = np.argmax(values, axis=-1)
+
+        actions = np.zeros((self.batch_size, self.dim))
+        actions[np.arange(self.batch_size), action_indices] = 1.0
+        self.a = actions
+        return self.a
+
+
 class PessMeanPolicy(Controller):
     def __init__(self, env, const=1.0, batch_size=1):
         super().__init__()
@@ -380,9 +496,11 @@ class UCBPolicy(Controller):
         return self.a
 
 
-class BanditTransformerController(Controller):
-    def __init__(self, model, sample=False,  batch_size=1):
-        self.model = model
+class BanditTransformerController(TransformerController):
+    def __init__(self, model, sample=False,  batch_size=1, kv_cache=False, evict=False,
+                 precision=None, traced=None):
+        super().__init__(model, kv_cache=kv_cache, evict=evict, precision=precision,
+                         traced=traced)
         self.du = model.config['action_dim']
         self.dx = model.config['state_dim']
         self.H = model.horizon
@@ -406,7 +524,7 @@ class BanditTransformerController(Controller):
         states = torch.tensor(x)[None, :].float().to(device)
         self.batch['query_states'] = states
 
-        a = self.model(self.batch)
+        a = self.predict()
         a = a.cpu().detach().numpy()[0]
 
         if self.sample:
@@ -428,7 +546,7 @@ class BanditTransformerController(Controller):
         states = states.float().to(device)
         self.batch['query_states'] = states
 
-        a = self.model(self.batch)
+        a = self.predict()
         a = a.cpu().detach().numpy()
         if self.batch_size == 1:
             a = a[0]
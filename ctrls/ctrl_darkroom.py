@@ -2,7 +2,7 @@ import numpy as np
 import scipy
 import torch
 
-from ctrls.ctrl_bandit import Controller
+from ctrls.ctrl_bandit import Controller, TransformerController
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -11,7 +11,6 @@ class DarkroomOptPolicy(Controller):
     def __init__(self, env):
         super().__init__()
         self.env = env
-        self.goal = env.goal
 
     def reset(self):
         return
@@ -20,9 +19,11 @@ class DarkroomOptPolicy(Controller):
         return self.env.opt_action(state)        
 
 
-class DarkroomTransformerController(Controller):
-    def __init__(self, model, batch_size=1, sample=False):
-        self.model = model
+class DarkroomTransformerController(TransformerController):
+    def __init__(self, model, batch_size=1, sample=False, kv_cache=False, evict=False,
+                 precision=None, traced=None):
+        super().__init__(model, kv_cache=kv_cache, evict=evict, precision=precision,
+                         traced=traced)
         self.state_dim = model.config['state_dim']
         self.action_dim = model.config['action_dim']
         self.horizon = model.horizon
@@ -40,7 +41,7 @@ class DarkroomTransformerController(Controller):
             states = states[None, :]
         self.batch['query_states'] = states
 
-        actions = self.model(self.batch).cpu().detach().numpy()
+        actions = self.predict().cpu().detach().numpy()
         if self.batch_size == 1:
             actions = actions[0]
 
@@ -1,13 +1,13 @@
 import numpy as np
 import scipy
-from skimage.transform import resize
 import torch
 from torchvision.transforms import transforms
 
-from ctrls.ctrl_bandit import Controller
+from ctrls.ctrl_bandit import Controller, TransformerController
+from image_utils import preprocess_images
+from utils import autocast
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-target_shape = (25, 25, 3)
 
 
 class MiniworldOptPolicy(Controller):
@@ -26,11 +26,8 @@ class MiniworldOptPolicy(Controller):
     def reset(self):
         return
 
-    def act(self, state, pose, angle):
-        actions = []
-        for i in range(self.batch_size):
-            actions.append(self.env.envs[i].opt_a(state[i], pose[i], angle[i]))
-        actions = np.array(actions)
+    def act(self, state, pose, angle, processed=None):
+        actions = np.array(self.env.opt_actions(state, pose, angle))
 
         zeros = np.zeros((self.batch_size, self.env.action_space.n))
         zeros[np.arange(self.batch_size), actions] = 1
@@ -41,7 +38,7 @@ class MiniworldRandPolicy(MiniworldOptPolicy):
     def __init__(self, env, batch_size=1):
         super().__init__(env, batch_size=batch_size)
 
-    def act(self, state, pose, angle):
+    def act(self, state, pose, angle, processed=None):
         actions = np.random.randint(
             self.env.action_space.n, size=self.batch_size)
         zeros = np.zeros((self.batch_size, self.env.action_space.n))
@@ -49,9 +46,20 @@ class MiniworldRandPolicy(MiniworldOptPolicy):
         return zeros
 
 
-class MiniworldTransformerController(Controller):
-    def __init__(self, model, batch_size=1, sample=False, save_video=False, filename_template=''):
-        self.model = model
+class MiniworldTransformerController(TransformerController):
+    """
+    With frame_cache=True the context frames are run through the image
+    encoder once, when they enter the context, and their encodings are
+    reused at every step (see FrameEmbeddingCache).
+    """
+    def __init__(self, model, batch_size=1, sample=False, save_video=False, filename_template='',
+                 frame_cache=False, kv_cache=False, evict=False, precision=None, traced=None):
+        super().__init__(model, kv_cache=kv_cache, evict=evict, precision=precision,
+                         traced=traced)
+        self.frame_cache = None
+        if frame_cache:
+            from net import FrameEmbeddingCache
+            self.frame_cache = FrameEmbeddingCache(model)
         self.action_dim = 4
         self.horizon = model.horizon
         self.transform = transforms.Compose([
@@ -65,17 +73,26 @@ class MiniworldTransformerController(Controller):
         self.save_video = save_video
         self.filename_template = filename_template
 
-    def act(self, image, pose, angle):
-        images = np.array(image)
-        if self.batch_size == 1:
-            images = images[None, :]
-
-        assert len(images.shape) == 4
-        images = [resize(image, target_shape, anti_aliasing=True)
-                  for image in images]
-        images = [self.transform(image) for image in images]
-
-        images = torch.stack(images).float().to(device)
+    def set_batch(self, batch):
+        if self.frame_cache is not None:
+            batch = dict(batch)
+            with autocast(self.precision):
+                batch['context_image_embeddings'] = self.frame_cache(batch['context_images'])
+        super().set_batch(batch)
+
+    def act(self, image, pose, angle, processed=None):
+        """
+        processed optionally holds the frames already resized and normalized
+        by preprocess_images, e.g. by the env, so they are not redone here.
+        """
+        if processed is None:
+            images = np.array(image)
+            if self.batch_size == 1:
+                images = images[None, :]
+            assert len(images.shape) == 4
+            processed = preprocess_images(images)
+
+        images = processed.float().to(device)
         assert images.shape[1] == 3
         assert images.shape[2] == 25
         assert images.shape[3] == 25
@@ -88,7 +105,7 @@ class MiniworldTransformerController(Controller):
         self.batch['query_states'] = torch.tensor(
             np.array(angle)).float().to(device)
 
-        actions = self.model(self.batch).cpu().detach().numpy()
+        actions = self.predict().cpu().detach().numpy()
         if self.batch_size == 1:
             actions = actions[0]
 
@@ -1,18 +1,199 @@
-import pickle
+import contextlib
+import hashlib
+import io
+import mmap
+import os
+import queue
+import threading
+import time
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 
-from utils import convert_to_tensor
+from columnar import (
+    columnar_path,
+    concat_columns,
+    is_columnar,
+    load_dataset_columns,
+    trajs_to_columns,
+)
+from image_utils import normalize_images, preprocess_images
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+CONTEXT_FIELDS = ('context_images', 'context_states', 'context_actions',
+                  'context_next_states', 'context_rewards')
+
+
+def shuffle_contexts(batch, generator=None):
+    """
+    Shuffles the context of every sample in a collated batch in place, with
+    one random permutation per sample drawn as the argsort of random keys
+    on the batch's device, from generator if given.
+    """
+    context_states = batch['context_states']
+    batch_size, horizon = context_states.shape[:2]
+    perm = torch.rand(batch_size, horizon, generator=generator,
+                      device=context_states.device).argsort(dim=1)
+    return permute_contexts(batch, perm)
+
+
+def permute_contexts(batch, perm):
+    """
+    Reorders the context of every sample in a batch in place by the
+    (batch_size, horizon) permutations perm.
+    """
+    batch_size, horizon = perm.shape
+    for key in CONTEXT_FIELDS:
+        if key in batch:
+            value = batch[key]
+            index = perm.view(batch_size, horizon, *[1] * (value.dim() - 2))
+            batch[key] = torch.gather(value, 1, index.expand_as(value))
+    return batch
+
+
+def _int_dtype(low, high):
+    for dtype in (np.int8, np.int16):
+        info = np.iinfo(dtype)
+        if low >= info.min and high <= info.max:
+            return dtype
+    return None
+
+
+def _row_slices(values, n_elements=1 << 20):
+    # Slices of whole rows holding about n_elements values each, so that
+    # temporaries stay small next to the field.
+    rows = max(1, n_elements // max(1, int(np.prod(values.shape[1:]))))
+    for start in range(0, len(values), rows):
+        yield slice(start, start + rows)
+
+
+class CompactField:
+    """
+    Stores a float field in the smallest form that reproduces it exactly:
+    one-hot rows as int8/int16 indices, a field holding a single value as
+    that value, and integer values as int8/int16. Selected rows are expanded
+    back to float32 on the device the field is stored on. The values are
+    checked and converted a block of rows at a time, so loading needs little
+    memory beyond the values and the compact field.
+    """
+
+    def __init__(self, values, store_gpu=True, one_hot=False):
+        values = np.asarray(values)
+        self.shape = values.shape
+        self.value = None
+
+        integer = constant = rows_sum_to_one = values.size > 0
+        low, high = np.inf, -np.inf
+        for rows in _row_slices(values):
+            block = values[rows]
+            if integer:
+                integer = np.array_equal(block, np.round(block))
+            if constant:
+                constant = bool(np.all(block == values.flat[0]))
+            if one_hot and rows_sum_to_one:
+                rows_sum_to_one = bool(np.all(block.sum(-1) == 1))
+            low, high = min(low, block.min()), max(high, block.max())
+
+        if one_hot and integer and rows_sum_to_one and low == 0:
+            self.kind = 'one_hot'
+            data = np.empty(self.shape[:-1], dtype=_int_dtype(0, self.shape[-1] - 1))
+            for rows in _row_slices(values):
+                data[rows] = values[rows].argmax(-1)
+        elif constant:
+            self.kind = 'constant'
+            self.value = float(values.flat[0])
+            data = np.zeros(0, dtype=np.float32)
+        elif integer and _int_dtype(low, high) is not None:
+            self.kind = 'integer'
+            data = np.empty(self.shape, dtype=_int_dtype(low, high))
+            for rows in _row_slices(values):
+                data[rows] = values[rows]
+        elif values.dtype == np.float32:
+            self.kind = 'float'
+            data = values
+        else:
+            self.kind = 'float'
+            data = np.empty(self.shape, dtype=np.float32)
+            for rows in _row_slices(values):
+                data[rows] = values[rows]
+
+        self.data = torch.from_numpy(np.ascontiguousarray(data))
+        if store_gpu:
+            self.data = self.data.to(device)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.data.element_size() * self.data.nelement()
+
+    def index_select(self, dim, index):
+        assert dim == 0, "CompactField only selects rows"
+        if self.kind == 'constant':
+            return torch.full((len(index), *self.shape[1:]), self.value,
+                              device=self.data.device)
+        data = self.data.index_select(0, index.to(self.data.device))
+        if self.kind == 'one_hot':
+            return F.one_hot(data.long(), self.shape[-1]).float()
+        return data.float()
+
+    def __getitem__(self, index):
+        return self.index_select(0, torch.as_tensor(index).reshape(1))[0]
+
+
+class _MemmapHandle:
+    """
+    Stands in for a memory-mapped array when a dataset is pickled, so that
+    DataLoader workers reopen the file instead of receiving its contents.
+    """
+
+    def __init__(self, array):
+        self.filename = array.filename
+        self.offset = array.offset
+        self.dtype = array.dtype
+        self.shape = array.shape
+
+    def open(self):
+        return np.memmap(self.filename, dtype=self.dtype, mode='r',
+                         offset=self.offset, shape=self.shape)
+
+
+def _to_handles(obj):
+    if isinstance(obj, torch.Tensor):
+        # Sent to workers as a handle to the same shared memory.
+        return obj if obj.is_cuda else obj.share_memory_()
+    if isinstance(obj, np.memmap) and isinstance(obj.base, mmap.mmap):
+        return _MemmapHandle(obj)
+    if isinstance(obj, dict):
+        return {key: _to_handles(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_to_handles(value) for value in obj]
+    return obj
+
+
+def _from_handles(obj):
+    if isinstance(obj, _MemmapHandle):
+        return obj.open()
+    if isinstance(obj, dict):
+        return {key: _from_handles(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_from_handles(value) for value in obj]
+    return obj
+
 
 class Dataset(torch.utils.data.Dataset):
     """Dataset class."""
 
+    # Fields read lazily from memory-mapped files instead of being loaded.
+    mmap_fields = ()
+
     def __init__(self, path, config):
         self.shuffle = config['shuffle']
+        # Shuffle whole batches at once rather than each sample separately.
+        self.batch_shuffle = self.shuffle and config.get('batch_shuffle', True)
         self.horizon = config['horizon']
         self.store_gpu = config['store_gpu']
         self.config = config
@@ -21,67 +202,79 @@ class Dataset(torch.utils.data.Dataset):
         if not isinstance(path, list):
             path = [path]
 
-        self.trajs = []
-        for p in path:
-            with open(p, 'rb') as f:
-                self.trajs += pickle.load(f)
-            
-        context_states = []
-        context_actions = []
-        context_next_states = []
-        context_rewards = []
-        query_states = []
-        optimal_actions = []
-
-        for traj in self.trajs:
-            context_states.append(traj['context_states'])
-            context_actions.append(traj['context_actions'])
-            context_next_states.append(traj['context_next_states'])
-            context_rewards.append(traj['context_rewards'])
-
-            query_states.append(traj['query_state'])
-            optimal_actions.append(traj['optimal_action'])
-
-        context_states = np.array(context_states)
-        context_actions = np.array(context_actions)
-        context_next_states = np.array(context_next_states)
-        context_rewards = np.array(context_rewards)
+        mmap_mode = 'r' if self.mmap_fields else None
+        columns_list = [load_dataset_columns(p, mmap_mode=mmap_mode) for p in path]
+        self.columns = concat_columns(columns_list, exclude=self.mmap_fields)
+        self.mmap_columns = [{key: columns[key] for key in self.mmap_fields}
+                             for columns in columns_list]
+
+        context_states = self.columns['context_states']
+        context_actions = self.columns['context_actions']
+        context_next_states = self.columns['context_next_states']
+        context_rewards = self.columns['context_rewards']
         if len(context_rewards.shape) < 3:
             context_rewards = context_rewards[:, :, None]
-        query_states = np.array(query_states)
-        optimal_actions = np.array(optimal_actions)
+        query_states = self.columns['query_state']
+        optimal_actions = self.columns['optimal_action']
+
+        # Contexts are stored once and shared by all of their queries.
+        self.context_index = torch.tensor(self.columns['context_index'])
+
+        # Samples are stored context by context. When every context has the
+        # same number of queries, batches can also be gathered by context.
+        self.queries_per_context = None
+        n_samples, n_contexts = len(self.context_index), len(context_states)
+        if n_contexts and n_samples % n_contexts == 0:
+            n_queries = n_samples // n_contexts
+            if torch.equal(self.context_index, torch.arange(n_samples) // n_queries):
+                self.queries_per_context = n_queries
 
+        if self.store_gpu:
+            self.context_index = self.context_index.to(device)
+
+        # Fields are stored compactly and expanded to float32 per batch.
         self.dataset = {
-            'query_states': convert_to_tensor(query_states, store_gpu=self.store_gpu),
-            'optimal_actions': convert_to_tensor(optimal_actions, store_gpu=self.store_gpu),
-            'context_states': convert_to_tensor(context_states, store_gpu=self.store_gpu),
-            'context_actions': convert_to_tensor(context_actions, store_gpu=self.store_gpu),
-            'context_next_states': convert_to_tensor(context_next_states, store_gpu=self.store_gpu),
-            'context_rewards': convert_to_tensor(context_rewards, store_gpu=self.store_gpu),
+            'query_states': CompactField(query_states, store_gpu=self.store_gpu),
+            'optimal_actions': CompactField(optimal_actions, store_gpu=self.store_gpu, one_hot=True),
+            'context_states': CompactField(context_states, store_gpu=self.store_gpu),
+            'context_actions': CompactField(context_actions, store_gpu=self.store_gpu, one_hot=True),
+            'context_next_states': CompactField(context_next_states, store_gpu=self.store_gpu),
+            'context_rewards': CompactField(context_rewards, store_gpu=self.store_gpu),
         }
 
-        self.zeros = np.zeros(
-            config['state_dim'] ** 2 + config['action_dim'] + 1
-        )
-        self.zeros = convert_to_tensor(self.zeros, store_gpu=self.store_gpu)
+        self.zeros = torch.zeros(config['state_dim'] ** 2 + config['action_dim'] + 1)
+        if self.store_gpu:
+            self.zeros = self.zeros.to(device)
 
     def __len__(self):
         'Denotes the total number of samples'
         return len(self.dataset['query_states'])
 
+    def __getstate__(self):
+        # Workers started with spawn receive tensors in shared memory and
+        # memory-mapped arrays as filenames, so nothing is copied per worker.
+        # The loaded columns were already converted and are left out.
+        state = dict(self.__dict__)
+        state.pop('columns', None)
+        return _to_handles(state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(_from_handles(state))
+
     def __getitem__(self, index):
         'Generates one sample of data'
+        context = self.context_index[index]
         res = {
-            'context_states': self.dataset['context_states'][index],
-            'context_actions': self.dataset['context_actions'][index],
-            'context_next_states': self.dataset['context_next_states'][index],
-            'context_rewards': self.dataset['context_rewards'][index],
+            'context_states': self.dataset['context_states'][context],
+            'context_actions': self.dataset['context_actions'][context],
+            'context_next_states': self.dataset['context_next_states'][context],
+            'context_rewards': self.dataset['context_rewards'][context],
             'query_states': self.dataset['query_states'][index],
             'optimal_actions': self.dataset['optimal_actions'][index],
             'zeros': self.zeros,
         }
 
-        if self.shuffle:
+        if self.shuffle and not self.batch_shuffle:
             perm = torch.randperm(self.horizon)
             res['context_states'] = res['context_states'][perm]
             res['context_actions'] = res['context_actions'][perm]
@@ -90,51 +283,475 @@ class Dataset(torch.utils.data.Dataset):
 
         return res
 
+    def collate(self, samples):
+        'Collates samples into a batch, shuffling contexts batch-wise'
+        batch = torch.utils.data.default_collate(samples)
+        if self.batch_shuffle:
+            shuffle_contexts(batch)
+        return batch
+
+    def get_batch(self, indices, generator=None):
+        'Generates a batch of samples from a tensor of indices'
+        contexts = self.context_index.index_select(0, indices)
+        res = {
+            'context_states': self.dataset['context_states'].index_select(0, contexts),
+            'context_actions': self.dataset['context_actions'].index_select(0, contexts),
+            'context_next_states': self.dataset['context_next_states'].index_select(0, contexts),
+            'context_rewards': self.dataset['context_rewards'].index_select(0, contexts),
+            'query_states': self.dataset['query_states'].index_select(0, indices),
+            'optimal_actions': self.dataset['optimal_actions'].index_select(0, indices),
+            'zeros': self.zeros.expand(len(indices), -1),
+        }
+        self._shuffle_batch(res, generator)
+        return res
+
+    def get_context_batch(self, contexts, generator=None):
+        """
+        Generates a batch of whole contexts from a tensor of context indices,
+        each with all of its queries: query_states and optimal_actions are
+        (batch, queries, dim), so that a context_first model encodes every
+        context once for all of its queries.
+        """
+        n_queries = self.queries_per_context
+        indices = contexts[:, None] * n_queries \
+            + torch.arange(n_queries, device=contexts.device)
+        indices = indices.flatten()
+        res = {
+            'context_states': self.dataset['context_states'].index_select(0, contexts),
+            'context_actions': self.dataset['context_actions'].index_select(0, contexts),
+            'context_next_states': self.dataset['context_next_states'].index_select(0, contexts),
+            'context_rewards': self.dataset['context_rewards'].index_select(0, contexts),
+            'query_states': self.dataset['query_states'].index_select(0, indices)
+                .view(len(contexts), n_queries, -1),
+            'optimal_actions': self.dataset['optimal_actions'].index_select(0, indices)
+                .view(len(contexts), n_queries, -1),
+            'zeros': self.zeros.expand(len(contexts), -1),
+        }
+        self._shuffle_batch(res, generator)
+        return res
+
+    def _shuffle_batch(self, batch, generator):
+        if self.batch_shuffle:
+            shuffle_contexts(batch, generator)
+        elif self.shuffle:
+            # One randperm per sample, as __getitem__ draws them.
+            device = batch['context_states'].device
+            perm = torch.stack([
+                torch.randperm(self.horizon, generator=generator, device=device)
+                for _ in range(len(batch['context_states']))])
+            permute_contexts(batch, perm)
+
+
+class BatchLoader:
+    """
+    Iterates over a Dataset in whole batches like a DataLoader with
+    shuffle=True, but gathers each batch with Dataset.get_batch instead of
+    collating batch_size separate samples. Indices live on the same device
+    as the data, so a dataset stored on the GPU never leaves it.
+
+    The order and context shuffles are drawn from the loader's own
+    generator, seeded with seed (or from the global RNG when the loader is
+    made), so iterating on another thread, e.g. in a Prefetcher, does not
+    race with the training loop for the global RNG.
+
+    With per_context=True batches are gathered with
+    Dataset.get_context_batch instead, batch_size // queries_per_context
+    whole contexts at a time.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, seed=None, per_context=False):
+        if per_context and dataset.queries_per_context is None:
+            raise ValueError("Contexts of the dataset have different numbers of queries")
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.per_context = per_context
+        if seed is None:
+            seed = int(torch.randint(2**62, (1,)).item())
+        self.generator = torch.Generator(device=dataset.context_index.device)
+        self.generator.manual_seed(seed)
+
+    def _units(self):
+        # The number of samples or contexts, and how many go in a batch.
+        if not self.per_context:
+            return len(self.dataset), self.batch_size
+        n_queries = self.dataset.queries_per_context
+        return len(self.dataset) // n_queries, max(1, self.batch_size // n_queries)
+
+    def __len__(self):
+        n, batch_size = self._units()
+        return (n + batch_size - 1) // batch_size
+
+    def __iter__(self):
+        n, batch_size = self._units()
+        gather = self.dataset.get_context_batch if self.per_context else self.dataset.get_batch
+        index_device = self.dataset.context_index.device
+        if self.shuffle:
+            order = torch.randperm(n, generator=self.generator, device=index_device)
+        else:
+            order = torch.arange(n, device=index_device)
+        for start in range(0, n, batch_size):
+            yield gather(order[start:start + batch_size], self.generator)
+
+
+def _load_images(images):
+    if images.dtype.kind == 'U':
+        # Datasets collected before images were packed store filepaths.
+        images = np.load(str(images))
+    return images
+
+
+def _dataset_stamp(path):
+    # Identifies the dataset contents a cache was built from.
+    if is_columnar(path):
+        with open(os.path.join(columnar_path(path), 'header.json'), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()[:12]
+    stat = os.stat(path)
+    return hashlib.sha1(f'{stat.st_size}-{stat.st_mtime_ns}'.encode()).hexdigest()[:12]
+
+
+def image_cache_path(path, dtype):
+    return os.path.join(columnar_path(path), 'cache',
+                        f'context_images_{dtype}_{_dataset_stamp(path)}.npy')
+
+
+def build_image_cache(context_images, filepath, dtype, chunk_size=64):
+    """
+    Preprocesses the context images of one dataset once into an
+    (n_contexts, H, 3, h, w) array at filepath and returns it memory-mapped.
+    float16 caches hold normalized frames; uint8 caches hold raw frames in
+    channel-first order, which only need to be normalized when loaded.
+    An existing cache is reused.
+    """
+    if os.path.isfile(filepath):
+        return np.load(filepath, mmap_mode='r')
+
+    first = _load_images(context_images[0])
+    shape = (len(context_images), len(first), 3, *first.shape[1:3])
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_filepath = filepath + '.tmp'
+    cache = np.lib.format.open_memmap(tmp_filepath, mode='w+', dtype=dtype, shape=shape)
+    for start in range(0, len(context_images), chunk_size):
+        images = np.stack([_load_images(images)
+                           for images in context_images[start:start + chunk_size]])
+        frames = images.reshape(-1, *images.shape[2:])
+        if dtype == 'uint8':
+            if frames.dtype != np.uint8:
+                frames = np.round(frames * 255).astype(np.uint8)
+            frames = frames.transpose(0, 3, 1, 2)
+        else:
+            frames = preprocess_images(frames).cpu().numpy()
+        cache[start:start + len(images)] = frames.reshape(len(images), *shape[1:])
+    cache.flush()
+    del cache
+    os.replace(tmp_filepath, filepath)
+    return np.load(filepath, mmap_mode='r')
+
+
+class ProceduralDataset(torch.utils.data.IterableDataset):
+    """
+    Samples new bandit, linear bandit or darkroom tasks and their roll-ins
+    on the fly, with the same generators as collect_data.py, instead of
+    reading a collected dataset. Every iteration is one epoch of n_samples
+    samples, split over the DataLoader workers in whole batches of
+    batch_size, so that only the last batch of the epoch is partial and the
+    DataLoader's length is the number of batches it yields. Tasks are generated
+    chunk_size envs at a time, from an RNG seeded by (seed, split, epoch,
+    worker), so a run is reproducible for a fixed number of workers as long
+    as the workers persist across epochs. With fixed=True every epoch
+    replays the first one, e.g. for a test set.
+
+    Split 1 samples darkroom goals from the held-out goals, and otherwise
+    only changes the seed.
+    """
+
+    def __init__(self, env, data_config, config, n_samples, seed=0, split=0,
+                 fixed=False, chunk_size=1000, batch_size=1):
+        from collect_data import darkroom_heldout_goals
+
+        self.env = env
+        self.data_config = data_config
+        self.n_samples = n_samples
+        self.seed = seed
+        self.split = split
+        self.fixed = fixed
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.epoch = 0
+
+        # Contexts are shuffled as they are generated, from the iterator's
+        # own RNG stream, rather than in collate.
+        self.shuffle = config['shuffle']
+        self.batch_shuffle = False
+        self.horizon = config['horizon']
+        self.zeros = torch.zeros(config['state_dim'] ** 2 + config['action_dim'] + 1)
+
+        if env == 'darkroom_heldout':
+            self.goals = darkroom_heldout_goals(data_config['dim'])[split]
+        elif env not in ('bandit', 'linear_bandit'):
+            raise NotImplementedError(f"No procedural data for {env}")
+
+    def __len__(self):
+        return self.n_samples
+
+    def generate(self, n_envs):
+        import collect_data
+
+        config = self.data_config
+        if self.env == 'bandit':
+            trajs = collect_data.generate_bandit_histories(
+                n_envs, config['dim'], config['horizon'], config['var'],
+                n_hists=config['n_hists'], n_samples=config['n_samples'],
+                cov=config['cov'], type=config['type'])
+        elif self.env == 'linear_bandit':
+            # The linear bandit generator reports progress per env.
+            with contextlib.redirect_stdout(io.StringIO()):
+                trajs = collect_data.generate_linear_bandit_histories(
+                    n_envs, config['dim'], config['lin_d'], config['horizon'],
+                    config['var'], config['n_hists'], config['n_samples'],
+                    data_type=config.get('data_type', 'thompson'))
+        else:
+            goals = self.goals[np.random.randint(len(self.goals), size=n_envs)]
+            trajs = collect_data.generate_darkroom_histories(
+                goals, config['dim'], config['horizon'],
+                n_hists=config['n_hists'], n_samples=config['n_samples'],
+                rollin_type=config['rollin_type'])
+        return trajs_to_columns(trajs)
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        worker_id, n_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        n_batches = -(-self.n_samples // self.batch_size)
+        batches = np.array_split(np.arange(n_batches), n_workers)[worker_id]
+        n_samples = 0
+        if len(batches):
+            n_samples = min(self.n_samples, (batches[-1] + 1) * self.batch_size) \
+                - batches[0] * self.batch_size
+        epoch = 0 if self.fixed else self.epoch
+        self.epoch += 1
+
+        seed = np.random.SeedSequence(self.seed, spawn_key=(self.split, epoch, worker_id))
+        np_seed, torch_seed = seed.generate_state(2)
+        rng_state = np.random.RandomState(np_seed).get_state()
+        generator = torch.Generator()
+        generator.manual_seed(int(torch_seed))
+        samples_per_env = self.data_config['n_hists'] * self.data_config['n_samples']
+
+        while n_samples > 0:
+            n_envs = min(self.chunk_size, -(-n_samples // samples_per_env))
+            # Generate from this iterator's own RNG stream, leaving the
+            # global one as it was.
+            global_state = np.random.get_state()
+            np.random.set_state(rng_state)
+            try:
+                columns = self.generate(n_envs)
+                rng_state = np.random.get_state()
+            finally:
+                np.random.set_state(global_state)
+
+            context = columns['context_index']
+            context_rewards = columns['context_rewards']
+            if len(context_rewards.shape) < 3:
+                context_rewards = context_rewards[:, :, None]
+            chunk = {
+                'context_states': columns['context_states'][context],
+                'context_actions': columns['context_actions'][context],
+                'context_next_states': columns['context_next_states'][context],
+                'context_rewards': context_rewards[context],
+                'query_states': columns['query_state'],
+                'optimal_actions': columns['optimal_action'],
+            }
+            chunk = {k: torch.tensor(np.asarray(v)).float() for k, v in chunk.items()}
+            if self.shuffle:
+                shuffle_contexts(chunk, generator)
+
+            for i in range(min(n_samples, len(context))):
+                res = {k: v[i] for k, v in chunk.items()}
+                res['zeros'] = self.zeros
+                yield res
+            n_samples -= len(context)
+
+    collate = Dataset.collate
+
+
+class Prefetcher:
+    """
+    Iterates over a loader on a background thread that keeps up to depth
+    batches ready on device. On CUDA, batches are staged in pinned memory
+    and copied on a side stream, so copies overlap with compute. The time
+    the training loop spends waiting for each batch is kept in wait_times.
+
+    Staging uses depth sets of pinned buffers that persist across epochs.
+    A set is reused once the copies out of it have completed, and a buffer
+    is only reallocated when a batch does not fit in it.
+    """
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_times = []
+        self.pinned = [{} for _ in range(max(1, depth))]
+        self.copy_events = [None] * len(self.pinned)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _stage(self, buffers, key, value):
+        buffer = buffers.get(key)
+        if (buffer is None or buffer.dtype != value.dtype
+                or buffer.shape[1:] != value.shape[1:] or len(buffer) < len(value)):
+            buffer = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+            buffers[key] = buffer
+        buffer = buffer[:len(value)]
+        buffer.copy_(value)
+        return buffer
+
+    def _to_device(self, batch, stream, buffers):
+        res = {}
+        for key, value in batch.items():
+            if stream is not None and value.device.type == 'cpu':
+                if not value.is_pinned():
+                    value = self._stage(buffers, key, value)
+                with torch.cuda.stream(stream):
+                    value = value.to(self.device, non_blocking=True)
+            else:
+                value = value.to(self.device)
+            res[key] = value
+        event = None
+        if stream is not None:
+            event = torch.cuda.Event()
+            event.record(stream)
+        return res, event
+
+    def _produce(self, batches, stop):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for i, batch in enumerate(self.loader):
+                slot = i % len(self.pinned)
+                if self.copy_events[slot] is not None:
+                    self.copy_events[slot].synchronize()
+                item = self._to_device(batch, stream, self.pinned[slot])
+                self.copy_events[slot] = item[1]
+                if not self._put(batches, stop, item):
+                    return
+            self._put(batches, stop, None)
+        except Exception as e:
+            self._put(batches, stop, e)
+
+    def _put(self, batches, stop, item):
+        # Gives up once the consumer has stopped, so the thread never blocks
+        # on a full queue that nobody reads anymore.
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        self.wait_times = []
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.wait_times.append(time.perf_counter() - start)
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for value in batch.values():
+                        value.record_stream(current)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def step_wait_times(self):
+        # The last wait is for the end of the epoch, not for a batch.
+        return self.wait_times[:-1]
+
+    def wait_summary(self):
+        waits = np.array(self.step_wait_times() or [0.0])
+        return (f"total {waits.sum():.3f}s, mean {1000 * waits.mean():.2f}ms, "
+                f"max {1000 * waits.max():.2f}ms")
+
 
 class ImageDataset(Dataset):
     """"Dataset class for image-based data."""
 
+    mmap_fields = ('context_images',)
+
     def __init__(self, paths, config, transform):
         config['store_gpu'] = False
         super().__init__(paths, config)
         self.transform = transform
         self.config = config
 
-        context_filepaths = []
-        query_images = []
+        # Context images stay memory-mapped, one uint8 array per dataset,
+        # and are located through the context offset of each dataset.
+        self.context_images = [columns['context_images'] for columns in self.mmap_columns]
 
-        for traj in self.trajs:
-            context_filepaths.append(traj['context_images'])
-            query_image = self.transform(traj['query_image']).float()
-            query_images.append(query_image)
+        # With an image cache, context frames are preprocessed once up front
+        # and samples only slice (and for uint8, normalize) their frames.
+        self.image_cache = config.get('image_cache')
+        if self.image_cache is not None:
+            if not isinstance(paths, list):
+                paths = [paths]
+            self.context_images = [
+                build_image_cache(images, image_cache_path(path, self.image_cache),
+                                  self.image_cache)
+                for path, images in zip(paths, self.context_images)]
+        self.context_offsets = np.cumsum(
+            [0] + [len(images) for images in self.context_images])
+        query_images = [self.transform(query_image).float()
+                        for query_image in self.columns['query_image']]
 
         self.dataset.update({
-            'context_filepaths': context_filepaths,
             'query_images': torch.stack(query_images),
         })
 
+    def load_context_images(self, context):
+        shard = np.searchsorted(self.context_offsets, context, side='right') - 1
+        return _load_images(self.context_images[shard][context - self.context_offsets[shard]])
+
     def __getitem__(self, index):
         'Generates one sample of data'
-        filepath = self.dataset['context_filepaths'][index]
-        context_images = np.load(filepath)
-        context_images = [self.transform(images) for images in context_images]
-        context_images = torch.stack(context_images).float()
+        context = self.context_index[index]
+        # Copy the frames out of the page cache in one sequential read.
+        context_images = np.array(self.load_context_images(int(context)))
+        if self.image_cache == 'float16':
+            context_images = torch.from_numpy(context_images).float()
+        elif self.image_cache == 'uint8':
+            context_images = normalize_images(torch.from_numpy(context_images).float() / 255)
+        else:
+            context_images = [self.transform(images) for images in context_images]
+            context_images = torch.stack(context_images).float()
 
         query_images = self.dataset['query_images'][index]
 
         res = {
             'context_images': context_images,#.to(device),
-            'context_states': self.dataset['context_states'][index],
-            'context_actions': self.dataset['context_actions'][index],
-            'context_next_states': self.dataset['context_next_states'][index],
-            'context_rewards': self.dataset['context_rewards'][index],
+            'context_states': self.dataset['context_states'][context],
+            'context_actions': self.dataset['context_actions'][context],
+            'context_next_states': self.dataset['context_next_states'][context],
+            'context_rewards': self.dataset['context_rewards'][context],
             'query_images': query_images,#.to(device),
             'query_states': self.dataset['query_states'][index],
             'optimal_actions': self.dataset['optimal_actions'][index],
             'zeros': self.zeros,
         }
 
-        if self.shuffle:
+        if self.shuffle and not self.batch_shuffle:
             perm = torch.randperm(self.horizon)
             res['context_images'] = res['context_images'][perm]
             res['context_states'] = res['context_states'][perm]
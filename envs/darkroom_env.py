@@ -173,3 +173,137 @@ class DarkroomEnvVec(BaseEnv):
         next_obs = np.stack(next_obs, axis=1)
         rews = np.stack(rews, axis=1)
         return obs, acts, next_obs, rews
+
+
+class DarkroomEnvBatch(BaseEnv):
+    """
+    Array-backed Darkroom environment simulating many rooms at once.
+    Goals are held as an (N, 2) array and actions are given either as (N,)
+    indices or as (N, 5) one-hot vectors. Optional per-env action
+    permutations cover DarkroomEnvPermuted.
+    """
+
+    # Grid displacement of each (unpermuted) action index.
+    moves = np.array([[1, 0], [-1, 0], [0, 1], [0, -1], [0, 0]])
+
+    def __init__(self, dim, goals, horizon, perms=None, perm_indices=None):
+        self.dim = dim
+        self.goals = np.array(goals, dtype=int).reshape(-1, 2)
+        self.horizon = horizon
+        self.state_dim = 2
+        self.action_dim = 5
+        self.observation_space = gym.spaces.Box(
+            low=0, high=dim - 1, shape=(self.state_dim,))
+        self.action_space = gym.spaces.Discrete(self.action_dim)
+
+        self._num_envs = len(self.goals)
+        self._rows = np.arange(self._num_envs)
+        if perms is None:
+            perms = np.tile(np.arange(self.action_dim), (self._num_envs, 1))
+        self.perms = np.array(perms, dtype=int)
+        self.inv_perms = np.argsort(self.perms, axis=-1)
+        self.perm_indices = perm_indices
+
+    @classmethod
+    def permuted(cls, dim, perm_indices, horizon):
+        """
+        Batched DarkroomEnvPermuted: the goal is always the bottom right corner.
+        """
+        perm_indices = np.asarray(perm_indices)
+        assert np.all(perm_indices < 120)     # 5! permutations in darkroom
+        permutations = np.array(list(itertools.permutations(range(5))))
+        goals = np.full((len(perm_indices), 2), dim - 1)
+        return cls(dim, goals, horizon,
+                   perms=permutations[perm_indices], perm_indices=perm_indices)
+
+    @classmethod
+    def from_envs(cls, envs):
+        """
+        Builds a batched environment from a list of DarkroomEnv(Permuted).
+        """
+        perms, perm_indices = None, None
+        if all(hasattr(env, 'perm_index') for env in envs):
+            perms = [env.perm for env in envs]
+            perm_indices = np.array([env.perm_index for env in envs])
+        return cls(envs[0].dim, [env.goal for env in envs], envs[0].horizon,
+                   perms=perms, perm_indices=perm_indices)
+
+    @property
+    def num_envs(self):
+        return self._num_envs
+
+    def _action_indices(self, actions):
+        actions = np.asarray(actions).reshape(self._num_envs, -1)
+        if actions.shape[-1] == self.action_dim:
+            return np.argmax(actions, axis=-1)
+        return actions[:, 0].astype(int)
+
+    def _one_hot(self, indices):
+        return np.eye(self.action_dim)[indices]
+
+    def sample_state(self):
+        return np.random.randint(0, self.dim, (self._num_envs, 2))
+
+    def sample_action(self):
+        return self._one_hot(
+            np.random.randint(0, self.action_dim, self._num_envs))
+
+    def reset(self):
+        self.current_step = 0
+        self.states = np.zeros((self._num_envs, 2), dtype=int)
+        return self.states.copy()
+
+    def transit(self, states, actions):
+        actions = self.perms[self._rows, self._action_indices(actions)]
+        states = np.clip(np.asarray(states) + self.moves[actions],
+                         0, self.dim - 1)
+        rewards = np.all(states == self.goals, axis=-1).astype(int)
+        return states, rewards
+
+    def step(self, actions):
+        if self.current_step >= self.horizon:
+            raise ValueError("Episode has already ended")
+
+        self.states, rewards = self.transit(self.states, actions)
+        self.current_step += 1
+        dones = np.full(self._num_envs, self.current_step >= self.horizon)
+        return self.states.copy(), rewards, dones, {}
+
+    def get_obs(self):
+        return self.states.copy()
+
+    def opt_action(self, states):
+        states = np.asarray(states).reshape(self._num_envs, 2)
+        # Same priority as DarkroomEnv.opt_action: first x, then y, else stay.
+        actions = np.full(self._num_envs, 4)
+        actions[states[:, 1] > self.goals[:, 1]] = 3
+        actions[states[:, 1] < self.goals[:, 1]] = 2
+        actions[states[:, 0] > self.goals[:, 0]] = 1
+        actions[states[:, 0] < self.goals[:, 0]] = 0
+        return self._one_hot(self.inv_perms[self._rows, actions])
+
+    def deploy(self, ctrl):
+        ob = self.reset()
+        obs = []
+        acts = []
+        next_obs = []
+        rews = []
+        done = False
+
+        while not done:
+            act = ctrl.act(ob)
+
+            obs.append(ob)
+            acts.append(np.reshape(act, (self._num_envs, -1)))
+
+            ob, rew, done, _ = self.step(act)
+            done = all(done)
+
+            rews.append(rew)
+            next_obs.append(ob)
+
+        obs = np.stack(obs, axis=1)
+        acts = np.stack(acts, axis=1)
+        next_obs = np.stack(next_obs, axis=1)
+        rews = np.stack(rews, axis=1)
+        return obs, acts, next_obs, rews
@@ -1,12 +1,13 @@
+import multiprocessing as mp
+
 import imageio
 import numpy as np
-from skimage.transform import resize
 import torch
 
 from envs.darkroom_env import DarkroomEnvVec
+from image_utils import preprocess_images
 
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-target_shape = (25, 25, 3)
+ENV_NAME = 'MiniWorld-OneRoomS6FastMultiFourBoxesFixedInit-v0'
 
 
 class MiniworldEnvVec(DarkroomEnvVec):
@@ -33,10 +34,31 @@ class MiniworldEnvVec(DarkroomEnvVec):
     def opt_a(self, x):
         return [env.opt_a(x) for env in self._envs]
 
+    def opt_actions(self, images, poses, angles):
+        return [env.opt_a(image, pose, angle)
+                for env, image, pose, angle in zip(self._envs, images, poses, angles)]
+
+    def agent_poses(self):
+        return [env.agent.pos[[0, -1]] for env in self._envs]
+
+    def agent_angles(self):
+        return [env.agent.dir_vec[[0, -1]] for env in self._envs]
+
+    def render_frames(self, actions):
+        return [env.unwrapped.render(goal_text=True, action=ac)
+                for env, ac in zip(self._envs, actions)]
+
+    def close(self):
+        for env in self._envs:
+            env.close()
+
     def deploy(self, ctrl):
+        # Raw frames are resized and normalized once per step, and the
+        # result is shared with the controller.
         images = self.reset()
-        pose = [env.agent.pos[[0, -1]] for env in self._envs]
-        angle = [env.agent.dir_vec[[0, -1]] for env in self._envs]
+        image_tensor = preprocess_images(images)
+        pose = self.agent_poses()
+        angle = self.agent_angles()
 
         obs = []
         states = []
@@ -50,30 +72,23 @@ class MiniworldEnvVec(DarkroomEnvVec):
 
         while not done:
 
-            action = ctrl.act(images, pose, angle)
+            action = ctrl.act(images, pose, angle, processed=image_tensor)
 
-            images = [resize(image, target_shape, anti_aliasing=True)
-                      for image in images]
-            image_tensor = torch.stack(
-                [ctrl.transform(image) for image in images])
             obs.append(image_tensor)
             states.append(angle)
             acts.append(action)
 
             images, rew, done, _, _ = self.step(np.argmax(action, axis=-1))
-            pose = [env.agent.pos[[0, -1]] for env in self._envs]   # unused
-            angle = [env.agent.dir_vec[[0, -1]] for env in self._envs]
+            pose = self.agent_poses()   # unused
+            angle = self.agent_angles()
             done = all(done)
 
             rews.append(rew)
-            next_image_tensor = torch.stack(
-                [ctrl.transform(image) for image in images])
-            next_obs.append(next_image_tensor)
+            image_tensor = preprocess_images(images)
+            next_obs.append(image_tensor)
 
             if ctrl.save_video:
-                imgs = [
-                    env.unwrapped.render(goal_text=True, action=ac)
-                    for env, ac in zip(self._envs, np.argmax(action, axis=-1))]
+                imgs = self.render_frames(np.argmax(action, axis=-1))
                 for i, img in enumerate(imgs):
                     videos[i].append(img)
 
@@ -89,3 +104,138 @@ class MiniworldEnvVec(DarkroomEnvVec):
             torch.stack(next_obs, axis=1),
             np.stack(rews, axis=1),
         )
+
+
+def _miniworld_worker(remote, env_name, env_ids):
+    import gymnasium as gym
+    import miniworld
+
+    envs = []
+    for env_id in env_ids:
+        env = gym.make(env_name)
+        env.set_task(env_id=env_id)
+        envs.append(env)
+
+    def agent_state():
+        return ([env.agent.pos[[0, -1]] for env in envs],
+                [env.agent.dir_vec[[0, -1]] for env in envs])
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'reset':
+                obs = [env.reset()[0] for env in envs]
+                remote.send((obs, *agent_state()))
+            elif cmd == 'step':
+                results = [env.step(action) for action, env in zip(data, envs)]
+                remote.send((
+                    [res[0] for res in results],
+                    [res[1] for res in results],
+                    [res[2] for res in results],
+                    *agent_state()))
+            elif cmd == 'opt_actions':
+                remote.send([env.opt_a(*args) for env, args in zip(envs, data)])
+            elif cmd == 'render':
+                remote.send([env.unwrapped.render(goal_text=True, action=ac)
+                             for env, ac in zip(envs, data)])
+            elif cmd == 'action_space':
+                remote.send(envs[0].action_space)
+            elif cmd == 'close':
+                break
+            else:
+                raise ValueError(f"Unknown command {cmd}")
+    finally:
+        for env in envs:
+            env.close()
+        remote.close()
+
+
+class MiniworldEnvSubproc(MiniworldEnvVec):
+    """
+    Vectorized MiniWorld environment whose envs live in worker processes.
+    Each worker builds and owns a contiguous slice of env_ids, and every
+    reset/step/render is sent to all workers before any result is awaited,
+    so rendering runs in parallel. Keeps the deploy contract of
+    MiniworldEnvVec.
+    """
+
+    def __init__(self, env_ids, n_workers, env_name=ENV_NAME):
+        self._num_envs = len(env_ids)
+        self._slices = [s for s in np.array_split(np.arange(self._num_envs), n_workers)
+                        if len(s) > 0]
+
+        # Spawned workers start without the parent's OpenGL or CUDA state.
+        ctx = mp.get_context('spawn')
+        self._remotes = []
+        self._processes = []
+        for indices in self._slices:
+            remote, worker_remote = ctx.Pipe()
+            process = ctx.Process(
+                target=_miniworld_worker,
+                args=(worker_remote, env_name, [int(env_ids[i]) for i in indices]),
+                daemon=True)
+            process.start()
+            worker_remote.close()
+            self._remotes.append(remote)
+            self._processes.append(process)
+
+        self._remotes[0].send(('action_space', None))
+        self.action_space = self._remotes[0].recv()
+        self._poses = None
+        self._angles = None
+        self._closed = False
+
+    @property
+    def envs(self):
+        raise AttributeError("MiniworldEnvSubproc envs live in worker processes")
+
+    def _scatter(self, cmd, data=None):
+        for remote, indices in zip(self._remotes, self._slices):
+            remote.send((cmd, None if data is None else [data[i] for i in indices]))
+        return [remote.recv() for remote in self._remotes]
+
+    def _gather(self, results, field):
+        return [x for res in results for x in res[field]]
+
+    def reset(self):
+        results = self._scatter('reset')
+        self._poses = self._gather(results, 1)
+        self._angles = self._gather(results, 2)
+        return self._gather(results, 0)
+
+    def step(self, actions):
+        results = self._scatter('step', actions)
+        self._poses = self._gather(results, 3)
+        self._angles = self._gather(results, 4)
+        next_obs = self._gather(results, 0)
+        rews = self._gather(results, 1)
+        dones = self._gather(results, 2)
+        return next_obs, rews, dones, None, {}
+
+    def opt_actions(self, images, poses, angles):
+        results = self._scatter('opt_actions', list(zip(images, poses, angles)))
+        return [x for res in results for x in res]
+
+    def agent_poses(self):
+        return self._poses
+
+    def agent_angles(self):
+        return self._angles
+
+    def render_frames(self, actions):
+        return [x for res in self._scatter('render', actions) for x in res]
+
+    def close(self):
+        if self._closed:
+            return
+        for remote in self._remotes:
+            remote.send(('close', None))
+        for process in self._processes:
+            process.join()
+        self._closed = True
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -1,13 +1,13 @@
 import argparse
 import os
-import pickle
 
 import matplotlib.pyplot as plt
 import torch
 from IPython import embed
 
 import common_args
-from evals import eval_bandit, eval_linear_bandit, eval_darkroom
+from columnar import load_trajs
+from evals import eval_bandit, eval_linear_bandit, eval_darkroom, eval_precision
 from net import Transformer, ImageTransformer
 from utils import (
     build_bandit_data_filename,
@@ -84,6 +84,9 @@ if __name__ == '__main__':
             'n_embd': n_embd,
             'n_layer': n_layer,
             'n_head': n_head,
+            'backbone': args['backbone'],
+            'layout': args['layout'],
+            'procedural': args['procedural'],
             'n_envs': n_envs,
             'n_hists': n_hists,
             'n_samples': n_samples,
@@ -142,6 +145,10 @@ if __name__ == '__main__':
             'n_layer': n_layer,
             'n_embd': n_embd,
             'n_head': n_head,
+            'backbone': args['backbone'],
+            'layout': args['layout'],
+            'precision': args['precision'],
+            'traced': args['traced'],
             'dropout': dropout,
             'test': True,
         }
@@ -153,6 +160,8 @@ if __name__ == '__main__':
         # NOTE: (michbaum) Broken now, would need changes
         config.update({'image_size': 25})
         model = ImageTransformer(config).to(device)
+        models.append(model)
+        filenames.append(filename)
     else:
         for config in configs:
             model = Transformer(config).to(device)
@@ -205,11 +214,14 @@ if __name__ == '__main__':
     else:
         raise ValueError(f'Environment {envname} not supported')
 
-    with open(eval_filepath, 'rb') as f:
-        eval_trajs = pickle.load(f)
+    eval_trajs = load_trajs(eval_filepath)
 
     n_eval = min(n_eval, len(eval_trajs))
 
+    if args['precision'] != 'fp32':
+        print(f"Checking {args['precision']} against fp32 on the eval set")
+        eval_precision.action_agreement(eval_trajs, models, n_eval, H, args['precision'])
+
     evals_filename = f"evals_epoch{epoch}"
     if not os.path.exists(f'figs/{evals_filename}'):
         os.makedirs(f'figs/{evals_filename}', exist_ok=True)
@@ -220,6 +232,9 @@ if __name__ == '__main__':
     if not os.path.exists(f'figs/{evals_filename}/graph'):
         os.makedirs(f'figs/{evals_filename}/graph', exist_ok=True)
 
+    # None leaves the choice to each env's evaluation.
+    kv_cache = {'auto': None, 'on': True, 'off': False}[args['kv_cache']]
+
     # Online and offline evaluation.
     if envname == 'bandit' or envname == 'bandit_bernoulli':
         config = {
@@ -229,7 +244,8 @@ if __name__ == '__main__':
             'n_eval': n_eval,
             'bandit_type': bandit_type,
         }
-        eval_bandit.online(eval_trajs, models, **config)
+        eval_bandit.online(
+            eval_trajs, models, kv_cache=kv_cache, kv_evict=args['kv_evict'], **config)
         plt.savefig(f'figs/{evals_filename}/online/{save_filename}.png')
         plt.clf()
         plt.cla()
@@ -254,7 +270,7 @@ if __name__ == '__main__':
         # with open(eval_filepath, 'rb') as f:
         #     eval_trajs = pickle.load(f)
 
-        eval_linear_bandit.online(eval_trajs, models, **config)
+        eval_linear_bandit.online(eval_trajs, models, kv_cache=kv_cache, **config)
         plt.savefig(f'figs/{evals_filename}/online/{save_filename}.png')
         plt.clf()
         plt.cla()
@@ -277,7 +293,7 @@ if __name__ == '__main__':
             'dim': dim,
             'permuted': True if envname == 'darkroom_permuted' else False,
         }
-        eval_darkroom.online(eval_trajs, models, **config)
+        eval_darkroom.online(eval_trajs, models, kv_cache=kv_cache, **config)
         plt.savefig(f'figs/{evals_filename}/online/{save_filename}.png')
         plt.clf()
 
@@ -292,14 +308,18 @@ if __name__ == '__main__':
         # NOTE: (michbaum) Broken now
         from evals import eval_miniworld
         save_video = args['save_video']
+        eval_workers = args['eval_workers']
         filename_prefix = f'videos/{save_filename}/{evals_filename}/'
         config = {
             'Heps': 40,
             'horizon': horizon,
             'H': H,
-            'n_eval': min(20, n_eval),
+            # Online eval is capped to keep single-process rendering tractable.
+            'n_eval': n_eval if eval_workers > 1 else min(20, n_eval),
             'save_video': save_video,
             'filename_template': filename_prefix + '{controller}_env{env_id}_ep{ep}_online.gif',
+            'n_workers': eval_workers,
+            'kv_cache': kv_cache,
         }
 
         if save_video and not os.path.exists(f'videos/{save_filename}/{evals_filename}'):
@@ -121,7 +121,8 @@ def deploy_online_vec(vec_env, controller, horizon, H=None, include_meta=False):
 
 
 
-def online(eval_trajs, models, n_eval, horizon, H, var, bandit_type):
+def online(eval_trajs, models, n_eval, horizon, H, var, bandit_type, kv_cache=None,
+           kv_evict=False):
     assert len(models) == len(H)
     all_means = {}
 
@@ -148,7 +149,9 @@ def online(eval_trajs, models, n_eval, horizon, H, var, bandit_type):
         controller = BanditTransformerController(
             model,
             sample=True,  # In the online setting we need to sample to actually explore
-            batch_size=len(envs))
+            batch_size=len(envs),
+            kv_cache=kv_cache is not False,
+            evict=kv_evict)
         cum_means = deploy_online_vec(vec_env, controller, horizon, h).T
         assert cum_means.shape[0] == n_eval
         all_means[f'DPT ctx {h}'] = cum_means
@@ -335,31 +338,83 @@ def offline(eval_trajs, models, n_eval, horizon, H, var, bandit_type):
     return baselines
 
 
-def offline_graph(eval_trajs, models, n_eval, horizon, H, var, bandit_type):
-    horizons = np.linspace(1, horizon, 50, dtype=int)
+def offline_prefixes(eval_trajs, models, n_eval, horizon, H, var, prefixes):
+    """
+    Offline evaluation at every prefix length of the eval contexts in one
+    pass. The baselines are computed from cumulative per-arm counts and
+    reward sums, and each model runs one forward pass whose causal
+    predictions cover all prefixes. Matches calling offline() with
+    horizon=h for every h in prefixes. Returns a dict of
+    (len(prefixes), n_eval) arrays of the mean reward of the chosen arms.
+    """
+    prefixes = np.asarray(prefixes)
+    trajs = eval_trajs[:n_eval]
+    means = np.array([traj['means'] for traj in trajs])
+    actions = np.array([traj['context_actions'][:horizon] for traj in trajs])
+    rewards = np.array([traj['context_rewards'][:horizon] for traj in trajs])
+    n_envs, dim = means.shape
+    rows = np.arange(n_envs)[:, None]
+
+    onehot = np.eye(dim)[np.argmax(actions, axis=-1)]
+    counts = np.cumsum(onehot, axis=1)[:, prefixes - 1]
+    sums = np.cumsum(onehot * rewards[:, :, None], axis=1)[:, prefixes - 1]
+    arm_means = sums / np.maximum(1, counts)
+
+    def value(arms):
+        return means[rows, arms].T
+
+    baselines = {'opt': np.tile(means.max(axis=1), (len(prefixes), 1))}
+    baselines['emp'] = value(np.argmax(arm_means, axis=-1))
+
+    # Thompson sampling posterior means, with the majority vote over 100
+    # posterior draws of ThompsonSamplingPolicy(sample=False).
+    prior_mean, prior_var, variance = 0.5, 1 / 12.0, var**2
+    # With var=0 arms never seen give 0/0 here; np.where drops those entries.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prior_weight = variance / (variance + counts * prior_var)
+        post_var = 1 / (1 / prior_var + counts / variance)
+    post_mean = np.where(counts > 0, prior_weight * prior_mean + (1 - prior_weight) * arm_means, prior_mean)
+    post_var = np.where(counts > 0, post_var, prior_var)
+    draws = np.random.normal(post_mean[:, :, None], np.sqrt(post_var)[:, :, None],
+                             size=(n_envs, len(prefixes), 100, dim))
+    freqs = np.eye(dim)[np.argmax(draws, axis=-1)].sum(axis=2)
+    baselines['thmp'] = value(np.argmax(freqs, axis=-1))
+
+    bounds = arm_means - .8 / np.maximum(1, np.sqrt(counts))
+    baselines['lcb'] = value(np.argmax(bounds, axis=-1))
 
-    all_means = []
-    all_sems = []
-    for h in horizons:
-        config = {
-            'horizon': h,
-            'H': H,
-            'var': var,
-            'n_eval': n_eval,
-            'bandit_type': bandit_type,
-        }
-        config['horizon'] = h
-        baselines = offline(eval_trajs, models, **config)
-        plt.clf()
+    batch = {
+        'query_states': torch.ones(n_envs, 1),
+        'zeros': torch.zeros(n_envs, 1 + dim + 1),
+        'context_states': torch.ones(n_envs, horizon, 1),
+        'context_actions': torch.tensor(actions),
+        'context_next_states': torch.ones(n_envs, horizon, 1),
+        'context_rewards': torch.tensor(rewards[:, :, None]),
+    }
+    batch = {k: v.float().to(device) for k, v in batch.items()}
+    for model, h in zip(models, H):
+        # Models see at most their own context size.
+        ctx_size = min(h, horizon)
+        model_batch = {k: v[:, :ctx_size] if k.startswith('context') else v
+                       for k, v in batch.items()}
+        with torch.no_grad():
+            preds = model.predict_prefixes(model_batch).cpu().numpy()
+        arms = np.argmax(preds[:, np.minimum(prefixes, ctx_size) - 1], axis=-1)
+        baselines[f'DPT ctx {h}'] = value(arms)
+
+    return baselines
 
-        means = {k: np.mean(v, axis=0) for k, v in baselines.items()}
-        sems = {k: scipy.stats.sem(v, axis=0) for k, v in baselines.items()}
-        all_means.append(means)
 
+def offline_graph(eval_trajs, models, n_eval, horizon, H, var, bandit_type):
+    horizons = np.linspace(1, horizon, 50, dtype=int)
+
+    baselines = offline_prefixes(eval_trajs, models, n_eval, horizon, H, var, horizons)
+    means = {k: np.mean(v, axis=1) for k, v in baselines.items()}
+    sems = {k: scipy.stats.sem(v, axis=1) for k, v in baselines.items()}
 
     for key in means.keys():
         if not key == 'opt':
-            regrets = [all_means[i]['opt'] - all_means[i][key] for i in range(len(horizons))]            
+            regrets = means['opt'] - means[key]
             plt.plot(horizons, regrets, label=key)
             plt.fill_between(horizons, regrets - sems[key], regrets + sems[key], alpha=0.2)
 
@@ -367,4 +422,3 @@ def offline_graph(eval_trajs, models, n_eval, horizon, H, var, bandit_type):
     plt.yscale('log')
     plt.xlabel('Dataset size')
     plt.ylabel('Suboptimality')
-    config['horizon'] = horizon
@@ -7,11 +7,7 @@ from ctrls.ctrl_darkroom import (
     DarkroomOptPolicy,
     DarkroomTransformerController,
 )
-from envs.darkroom_env import (
-    DarkroomEnv,
-    DarkroomEnvPermuted,
-    DarkroomEnvVec,
-)
+from envs.darkroom_env import DarkroomEnvBatch
 from utils import convert_to_tensor
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -152,26 +148,27 @@ def deploy_online_vec(vec_env, controller, Heps, H, horizon):
     return np.stack(cum_means, axis=1)
 
 
-def online(eval_trajs, models, Heps, H, n_eval, dim, horizon, permuted=False):
+def online(eval_trajs, models, Heps, H, n_eval, dim, horizon, permuted=False, kv_cache=None):
     # assert H % horizon == 0  # (michbaum) Why? Context needs to be divisible by the horizon?
     assert len(models) == len(H)
 
     for model, h in zip(models, H):
         all_means_lnr = []
 
-        envs = []
-        for i_eval in range(n_eval):
-            print(f"Eval traj: {i_eval}")
-            traj = eval_trajs[i_eval]
-            if permuted:
-                env = DarkroomEnvPermuted(dim, traj['perm_index'], horizon)
-            else:
-                env = DarkroomEnv(dim, traj['goal'], horizon)
-            envs.append(env)
+        trajs = eval_trajs[:n_eval]
+        if permuted:
+            vec_env = DarkroomEnvBatch.permuted(
+                dim, [traj['perm_index'] for traj in trajs], horizon)
+        else:
+            vec_env = DarkroomEnvBatch(
+                dim, [traj['goal'] for traj in trajs], horizon)
 
+        # The context is fixed within an episode, so with the context_first
+        # layout each step only runs the query on the cached context.
+        if kv_cache is None:
+            kv_cache = model.layout == 'context_first'
         lnr_controller = DarkroomTransformerController(
-            model, batch_size=n_eval, sample=True)
-        vec_env = DarkroomEnvVec(envs)
+            model, batch_size=n_eval, sample=True, kv_cache=kv_cache)
         # cum_means_lnr = deploy_online_vec(vec_env, lnr_controller, Heps, H, horizon)
         cum_means_lnr = deploy_online_vec_w_frac(vec_env, lnr_controller, Heps, h, horizon)
 
@@ -194,42 +191,18 @@ def online(eval_trajs, models, Heps, H, n_eval, dim, horizon, permuted=False):
 
 
 def offline(eval_trajs, model, n_eval, H, dim, permuted=False):
-    all_rs_opt = []
-    all_rs_lnr = []
-    all_rs_lnr_greedy = []
-
-    envs = []
-    trajs = []
-
-    for i_eval in range(n_eval):
-        print(f"Eval traj: {i_eval}")
-
-        traj = eval_trajs[i_eval]
-        batch = {
-            'context_states': convert_to_tensor(traj['context_states'][None, :, :]),
-            'context_actions': convert_to_tensor(traj['context_actions'][None, :, :]),
-            'context_next_states': convert_to_tensor(traj['context_next_states'][None, :, :]),
-            'context_rewards': convert_to_tensor(traj['context_rewards'][None, :, None]),
-        }
-
-        if permuted:
-            env = DarkroomEnvPermuted(dim, traj['perm_index'], H)
-        else:
-            env = DarkroomEnv(dim, traj['goal'], H)
-
-        true_opt = DarkroomOptPolicy(env)
-        true_opt.set_batch(batch)
-
-        _, _, _, rs_opt = env.deploy_eval(true_opt)
-        all_rs_opt.append(np.sum(rs_opt))
-
-        envs.append(env)
-        trajs.append(traj)
+    trajs = eval_trajs[:n_eval]
+    if permuted:
+        vec_env = DarkroomEnvBatch.permuted(
+            dim, [traj['perm_index'] for traj in trajs], H)
+    else:
+        vec_env = DarkroomEnvBatch(dim, [traj['goal'] for traj in trajs], H)
 
-        
+    true_opt = DarkroomOptPolicy(vec_env)
+    _, _, _, rs_opt = vec_env.deploy_eval(true_opt)
+    all_rs_opt = np.sum(rs_opt, axis=-1)
 
     print("Running darkroom offline evaluations in parallel")
-    vec_env = DarkroomEnvVec(envs)
     lnr = DarkroomTransformerController(
         model, batch_size=n_eval, sample=True)
     lnr_greedy = DarkroomTransformerController(
@@ -98,7 +98,7 @@ def deploy_online_vec(vec_env, controller, horizon, include_meta=False):
 
 
 
-def online(eval_trajs, model, n_eval, horizon, var):
+def online(eval_trajs, model, n_eval, horizon, var, kv_cache=None):
 
     all_means = {}
 
@@ -125,7 +125,8 @@ def online(eval_trajs, model, n_eval, horizon, var):
     controller = BanditTransformerController(
         model,
         sample=True,
-        batch_size=len(envs))
+        batch_size=len(envs),
+        kv_cache=kv_cache is not False)
     cum_means = deploy_online_vec(vec_env, controller, horizon).T
     assert cum_means.shape[0] == n_eval
     all_means['Lnr'] = cum_means
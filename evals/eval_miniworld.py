@@ -14,7 +14,8 @@ from ctrls.ctrl_miniworld import (
     MiniworldRandPolicy,
     MiniworldTransformerController,
 )
-from envs.miniworld_env import MiniworldEnvVec
+from envs.miniworld_env import ENV_NAME, MiniworldEnvSubproc, MiniworldEnvVec
+from image_utils import preprocess_images
 from utils import convert_to_tensor
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -108,59 +109,73 @@ def deploy_online_vec(vec_env, controller, Heps, H, horizon, filename_template='
     return np.stack(cum_means, axis=1)
 
 
-def online(eval_trajs, model, Heps, horizon, H, n_eval, save_video=False, filename_template=''):
-    assert H % horizon == 0
-
-    all_means_lnr = []
+def make_vec_env(env_ids, n_workers=1):
+    if n_workers > 1:
+        return MiniworldEnvSubproc(env_ids, n_workers)
 
     envs = []
-
-    for i_eval in range(n_eval):
-        print(f"Eval traj: {i_eval}")
-        env = gym.make('MiniWorld-OneRoomS6FastMultiFourBoxesFixedInit-v0')
-        env.set_task(env_id=8000 + i_eval)
+    for env_id in env_ids:
+        print(f"Eval env id: {env_id}")
+        env = gym.make(ENV_NAME)
+        env.set_task(env_id=env_id)
         envs.append(env)
+    return MiniworldEnvVec(envs)
 
-    vec_env = MiniworldEnvVec(envs)
-
-    # Learner
-    print("Evaluating learner")
-    lnr_filename_template = partial(filename_template.format, controller='lnr')
-    lnr_controller = MiniworldTransformerController(
-        model,
-        batch_size=n_eval,
-        sample=True,
-        save_video=save_video,
-        filename_template=lnr_filename_template)
-    cum_means_lnr = deploy_online_vec(
-        vec_env, lnr_controller, Heps, H, horizon, lnr_filename_template, learner=True)
-
-    all_means_lnr = np.array(cum_means_lnr)
-    means_lnr = np.mean(all_means_lnr, axis=0)
-    sems_lnr = scipy.stats.sem(all_means_lnr, axis=0)
-
-    # Optimal policy
-    print("Evaluating optimal policy")
-    opt_filename_template = partial(filename_template.format, controller='opt')
-    opt_controller = MiniworldOptPolicy(
-        vec_env, batch_size=n_eval, save_video=save_video, filename_template=opt_filename_template)
-    cum_means_opt = deploy_online_vec(
-        vec_env, opt_controller, 1, H, horizon, opt_filename_template)
-    cum_means_opt = np.repeat(cum_means_opt, Heps, axis=-1)
-
-    all_means_opt = np.array(cum_means_opt)
-    means_opt = np.mean(all_means_opt, axis=0)
-    sems_opt = scipy.stats.sem(all_means_opt, axis=0)
-
-    # Random policy
-    print("Evaluating random policy")
-    rand_controller = MiniworldRandPolicy(vec_env, batch_size=n_eval)
-    cum_means_rand = deploy_online_vec(
-        vec_env, rand_controller, Heps, H, horizon)
-
-    all_means_rand = np.array(cum_means_rand)
-    means_rand = np.mean(all_means_rand, axis=0)
-    sems_rand = scipy.stats.sem(all_means_rand, axis=0)
+
+def online(eval_trajs, model, Heps, horizon, H, n_eval, save_video=False, filename_template='', n_workers=1,
+           kv_cache=None):
+    assert H % horizon == 0
+    if kv_cache is None:
+        kv_cache = model.layout == 'context_first'
+
+    all_means_lnr = []
+
+    vec_env = make_vec_env([8000 + i_eval for i_eval in range(n_eval)], n_workers)
+    try:
+        # Learner
+        print("Evaluating learner")
+        lnr_filename_template = partial(filename_template.format, controller='lnr')
+        # The context is fixed within an episode, so with the context_first
+        # layout each step only runs the query on the cached context.
+        lnr_controller = MiniworldTransformerController(
+            model,
+            batch_size=n_eval,
+            sample=True,
+            save_video=save_video,
+            filename_template=lnr_filename_template,
+            frame_cache=True,
+            kv_cache=kv_cache)
+        cum_means_lnr = deploy_online_vec(
+            vec_env, lnr_controller, Heps, H, horizon, lnr_filename_template, learner=True)
+
+        all_means_lnr = np.array(cum_means_lnr)
+        means_lnr = np.mean(all_means_lnr, axis=0)
+        sems_lnr = scipy.stats.sem(all_means_lnr, axis=0)
+
+        # Optimal policy
+        print("Evaluating optimal policy")
+        opt_filename_template = partial(filename_template.format, controller='opt')
+        opt_controller = MiniworldOptPolicy(
+            vec_env, batch_size=n_eval, save_video=save_video, filename_template=opt_filename_template)
+        cum_means_opt = deploy_online_vec(
+            vec_env, opt_controller, 1, H, horizon, opt_filename_template)
+        cum_means_opt = np.repeat(cum_means_opt, Heps, axis=-1)
+
+        all_means_opt = np.array(cum_means_opt)
+        means_opt = np.mean(all_means_opt, axis=0)
+        sems_opt = scipy.stats.sem(all_means_opt, axis=0)
+
+        # Random policy
+        print("Evaluating random policy")
+        rand_controller = MiniworldRandPolicy(vec_env, batch_size=n_eval)
+        cum_means_rand = deploy_online_vec(
+            vec_env, rand_controller, Heps, H, horizon)
+
+        all_means_rand = np.array(cum_means_rand)
+        means_rand = np.mean(all_means_rand, axis=0)
+        sems_rand = scipy.stats.sem(all_means_rand, axis=0)
+    finally:
+        vec_env.close()
 
     # plot individual curves
     for i in range(n_eval):
@@ -194,69 +209,67 @@ def online(eval_trajs, model, Heps, horizon, H, n_eval, save_video=False, filena
     return baselines
 
 
-def offline(eval_trajs, model, n_eval, save_video=False, filename_template=''):
+def offline(eval_trajs, model, n_eval, save_video=False, filename_template='', n_workers=1,
+            kv_cache=None):
+    if kv_cache is None:
+        kv_cache = model.layout == 'context_first'
     all_rs_lnr = []
     all_rs_lnr_greedy = []
 
-    envs = []
-    trajs = []
-
-    for i_eval in range(n_eval):
-        traj = eval_trajs[i_eval]
-        trajs.append(traj)
-        env_id = traj['env_id']
-
-        print(f"Eval traj id: {env_id}")
-
-        env = gym.make('MiniWorld-OneRoomS6FastMultiFourBoxesFixedInit-v0')
-        env.set_task(env_id=env_id)
-        envs.append(env)
-
+    trajs = eval_trajs[:n_eval]
 
     print("Running darkroom offline evaluations in parallel")
-    vec_env = MiniworldEnvVec(envs)
-    lnr_filename_template = partial(filename_template.format, controller='lnr')
-    lnr = MiniworldTransformerController(
-        model,
-        batch_size=n_eval,
-        sample=True,
-        save_video=save_video,
-        filename_template=lnr_filename_template)
-    lnr_greedy_filename_template = partial(
-        filename_template.format, controller='lnr_greedy')
-    lnr_greedy = MiniworldTransformerController(
-        model,
-        batch_size=n_eval,
-        sample=False,
-        save_video=save_video,
-        filename_template=lnr_greedy_filename_template)
-    opt_filename_template = partial(filename_template.format, controller='opt')
-    opt = MiniworldOptPolicy(
-        vec_env, batch_size=n_eval, save_video=False, filename_template=opt_filename_template)
-    rand = MiniworldRandPolicy(vec_env, batch_size=n_eval)
-
-    context_images = []
-    for traj in trajs:
-        images = np.load(traj['context_images'])
-        images = [lnr.transform(image) for image in images]
-        images = torch.stack(images).float().to(device)
-        context_images.append(images)
-    batch = {
-        'context_images': torch.stack(context_images),
-        'context_states': convert_to_tensor([traj['context_states'] for traj in trajs]),
-        'context_actions': convert_to_tensor([traj['context_actions'] for traj in trajs]),
-        'context_rewards': convert_to_tensor([traj['context_rewards'][:, None] for traj in trajs]),
-    }
-
-    lnr.set_batch(batch)
-    lnr_greedy.set_batch(batch)
-    opt.set_batch(batch)
-    rand.set_batch(batch)
+    vec_env = make_vec_env([int(traj['env_id']) for traj in trajs], n_workers)
+    try:
+        lnr_filename_template = partial(filename_template.format, controller='lnr')
+        lnr = MiniworldTransformerController(
+            model,
+            batch_size=n_eval,
+            sample=True,
+            save_video=save_video,
+            filename_template=lnr_filename_template,
+            frame_cache=True,
+            kv_cache=kv_cache)
+        lnr_greedy_filename_template = partial(
+            filename_template.format, controller='lnr_greedy')
+        lnr_greedy = MiniworldTransformerController(
+            model,
+            batch_size=n_eval,
+            sample=False,
+            save_video=save_video,
+            filename_template=lnr_greedy_filename_template,
+            frame_cache=True,
+            kv_cache=kv_cache)
+        opt_filename_template = partial(filename_template.format, controller='opt')
+        opt = MiniworldOptPolicy(
+            vec_env, batch_size=n_eval, save_video=False, filename_template=opt_filename_template)
+        rand = MiniworldRandPolicy(vec_env, batch_size=n_eval)
+
+        context_images = []
+        for traj in trajs:
+            images = traj['context_images']
+            if isinstance(images, str):
+                images = np.load(images)
+            images = preprocess_images(images)
+            context_images.append(images)
+        batch = {
+            'context_images': torch.stack(context_images),
+            'context_states': convert_to_tensor([traj['context_states'] for traj in trajs]),
+            'context_actions': convert_to_tensor([traj['context_actions'] for traj in trajs]),
+            'context_rewards': convert_to_tensor([traj['context_rewards'][:, None] for traj in trajs]),
+        }
 
-    _, _, _, _, rs_lnr = vec_env.deploy_eval(lnr)
-    _, _, _, _, rs_lnr_greedy = vec_env.deploy_eval(lnr_greedy)
-    _, _, _, _, rs_opt = vec_env.deploy_eval(opt)
-    _, _, _, _, rs_rand = vec_env.deploy_eval(rand)
+        lnr.set_batch(batch)
+        lnr_greedy.set_batch(batch)
+        opt.set_batch(batch)
+        rand.set_batch(batch)
+
+        _, _, _, _, rs_lnr = vec_env.deploy_eval(lnr)
+        _, _, _, _, rs_lnr_greedy = vec_env.deploy_eval(lnr_greedy)
+        _, _, _, _, rs_opt = vec_env.deploy_eval(opt)
+        _, _, _, _, rs_rand = vec_env.deploy_eval(rand)
+    finally:
+        vec_env.close()
 
     all_rs_lnr = np.sum(rs_lnr, axis=-1)
     all_rs_lnr_greedy = np.sum(rs_lnr_greedy, axis=-1)
@@ -0,0 +1,54 @@
+import numpy as np
+import torch
+
+from image_utils import preprocess_images
+from utils import autocast, convert_to_tensor
+
+
+def _load_images(images):
+    if isinstance(images, str):
+        images = np.load(images)
+    return preprocess_images(images)
+
+
+def action_agreement(eval_trajs, models, n_eval, H, precision):
+    """
+    Parity check of a reduced precision against fp32: the fraction of eval
+    contexts and prefix lengths for which a model picks the same greedy
+    action in both. Every model sees at most its own context size. Image
+    models get the eval frames preprocessed as in deployment. Returns one
+    rate per model.
+    """
+    trajs = eval_trajs[:n_eval]
+    rewards = np.array([traj['context_rewards'] for traj in trajs])
+    if rewards.ndim == 2:
+        rewards = rewards[:, :, None]
+    batch = {
+        'query_states': convert_to_tensor([traj['query_state'] for traj in trajs]),
+        'context_states': convert_to_tensor([traj['context_states'] for traj in trajs]),
+        'context_actions': convert_to_tensor([traj['context_actions'] for traj in trajs]),
+        'context_rewards': convert_to_tensor(rewards),
+    }
+    if 'context_next_states' in trajs[0]:
+        batch['context_next_states'] = convert_to_tensor(
+            [traj['context_next_states'] for traj in trajs])
+    if 'context_images' in trajs[0]:
+        batch['context_images'] = torch.stack(
+            [_load_images(traj['context_images']) for traj in trajs])
+        batch['query_images'] = preprocess_images(
+            np.array([traj['query_image'] for traj in trajs]))
+
+    rates = []
+    for model, h in zip(models, H):
+        zeros_dim = model.state_dim ** 2 + model.action_dim + 1
+        model_batch = {k: v[:, :h] if k.startswith('context') else v
+                       for k, v in batch.items()}
+        model_batch['zeros'] = torch.zeros(len(trajs), zeros_dim, device=batch['query_states'].device)
+        with torch.no_grad():
+            reference = model.predict_prefixes(model_batch).argmax(dim=-1)
+            with autocast(precision):
+                actions = model.predict_prefixes(model_batch).float().argmax(dim=-1)
+        rates.append((actions == reference).float().mean().item())
+        print(f"DPT ctx {h}: {precision} picks the fp32 action "
+              f"{100 * rates[-1]:.2f}% of the time")
+    return rates
@@ -0,0 +1,95 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+target_shape = (25, 25, 3)
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def _to_nchw(images, device):
+    images = torch.as_tensor(np.asarray(images), device=device)
+    if images.dtype == torch.uint8:
+        images = images.float() / 255.0
+    return images.float().permute(0, 3, 1, 2)
+
+
+def _gaussian_blur(images, axis, sigma):
+    # scipy.ndimage.gaussian_filter along one axis, in its 'mirror' mode.
+    radius = int(4.0 * sigma + 0.5)
+    offsets = torch.arange(-radius, radius + 1, dtype=images.dtype, device=images.device)
+    kernel = torch.exp(-0.5 * (offsets / sigma) ** 2)
+    kernel = kernel / kernel.sum()
+    channels = images.shape[1]
+    if axis == 2:
+        images = F.pad(images, (0, 0, radius, radius), mode='reflect')
+        kernel = kernel.view(1, 1, -1, 1)
+    else:
+        images = F.pad(images, (radius, radius, 0, 0), mode='reflect')
+        kernel = kernel.view(1, 1, 1, -1)
+    return F.conv2d(images, kernel.expand(channels, -1, -1, -1), groups=channels)
+
+
+def _linear_sample(images, axis, n_out):
+    # scipy.ndimage.zoom(order=1, grid_mode=True) along one axis: linear
+    # interpolation at the output pixel centers, mirrored at the edges.
+    n_in = images.shape[axis]
+    coords = (torch.arange(n_out, dtype=images.dtype, device=images.device) + 0.5) \
+        * (n_in / n_out) - 0.5
+    coords = coords.abs()
+    coords = torch.where(coords > n_in - 1, 2 * (n_in - 1) - coords, coords)
+    lo = coords.floor().long().clamp(0, n_in - 1)
+    hi = (lo + 1).clamp(max=n_in - 1)
+    shape = [1] * images.dim()
+    shape[axis] = n_out
+    weight = (coords - lo).view(shape)
+    return (images.index_select(axis, lo) * (1 - weight)
+            + images.index_select(axis, hi) * weight)
+
+
+def _resize_nchw(images, shape=target_shape):
+    # Same filter as skimage.transform.resize(anti_aliasing=True), which
+    # the existing datasets and checkpoints were made with: a Gaussian blur
+    # with sigma (factor - 1) / 2 along each downsampled axis, then linear
+    # interpolation at the pixel centers.
+    size = tuple(shape[:2])
+    if tuple(images.shape[2:]) == size:
+        return images
+    for axis, (n_in, n_out) in enumerate(zip(images.shape[2:], size), start=2):
+        sigma = (n_in / n_out - 1) / 2
+        if sigma > 0:
+            images = _gaussian_blur(images, axis, sigma)
+        if n_in != n_out:
+            images = _linear_sample(images, axis, n_out)
+    return images.clamp(0.0, 1.0)
+
+
+def resize_images(images, shape=target_shape):
+    """
+    Resizes a (N, H, W, 3) stack of uint8 or [0, 1] float frames to shape
+    in one anti-aliased call, matching skimage.transform.resize to within
+    1e-5. Returns float32 frames in [0, 1] as numpy.
+    Runs on the CPU, so it is safe to call from data collection workers.
+    """
+    images = _resize_nchw(_to_nchw(images, 'cpu'), shape)
+    return images.permute(0, 2, 3, 1).cpu().numpy()
+
+
+def normalize_images(images):
+    """
+    Normalizes (N, 3, h, w) [0, 1] frames with the ImageNet statistics
+    used by the image transformer.
+    """
+    mean = torch.tensor(IMAGENET_MEAN, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=images.device).view(1, 3, 1, 1)
+    return (images - mean) / std
+
+
+def preprocess_images(images, shape=target_shape):
+    """
+    Resizes and normalizes a (N, H, W, 3) stack of raw frames. Returns a
+    (N, 3, h, w) float tensor on device, ready to be fed to the model.
+    """
+    return normalize_images(_resize_nchw(_to_nchw(images, device), shape))
@@ -1,11 +1,157 @@
+import argparse
+import math
+import warnings
+
 import torch
 import torch.nn as nn
-import transformers
-transformers.set_seed(0)
-from transformers import GPT2Config, GPT2Model
+import torch.nn.functional as F
 from IPython import embed
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+
+class CausalSelfAttention(nn.Module):
+    """
+    GPT-2 attention with n_head heads, through the fused
+    scaled_dot_product_attention kernel where torch provides it.
+    """
+
+    def __init__(self, n_embd, n_head, dropout):
+        super().__init__()
+        assert n_embd % n_head == 0, "n_embd must be divisible by n_head"
+        self.n_head = n_head
+        self.dropout = dropout
+        self.c_attn = nn.Linear(n_embd, 3 * n_embd)
+        self.c_proj = nn.Linear(n_embd, n_embd)
+        self.resid_dropout = nn.Dropout(dropout)
+
+    def _heads(self, x):
+        batch_size, n_tokens, n_embd = x.shape
+        return x.view(batch_size, n_tokens, self.n_head, n_embd // self.n_head).transpose(1, 2)
+
+    def forward(self, x, past=None, mask=None):
+        batch_size, n_tokens, n_embd = x.shape
+        q, k, v = (self._heads(t) for t in self.c_attn(x).split(n_embd, dim=2))
+        n_past = 0
+        if past is not None:
+            n_past = past[0].shape[2]
+            k = torch.cat([past[0], k], dim=2)
+            v = torch.cat([past[1], v], dim=2)
+
+        dropout = self.dropout if self.training else 0.0
+        # Unless a mask is given, new tokens attend to all cached tokens and
+        # causally among themselves.
+        if mask is None and n_past > 0:
+            positions = torch.arange(n_past + n_tokens, device=x.device)
+            mask = positions[None, :] <= positions[n_past:, None]
+        if hasattr(F, 'scaled_dot_product_attention'):
+            y = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=mask, dropout_p=dropout, is_causal=mask is None)
+        else:
+            if mask is None:
+                mask = torch.ones(n_tokens, n_tokens, dtype=torch.bool, device=x.device).tril()
+            att = (q @ k.transpose(-2, -1)) / math.sqrt(q.shape[-1])
+            att = att.masked_fill(~mask, float('-inf')).softmax(dim=-1)
+            y = F.dropout(att, dropout, self.training) @ v
+
+        y = y.transpose(1, 2).reshape(batch_size, n_tokens, n_embd)
+        return self.resid_dropout(self.c_proj(y)), (k, v)
+
+
+class MLP(nn.Module):
+    def __init__(self, n_embd, dropout):
+        super().__init__()
+        self.c_fc = nn.Linear(n_embd, 4 * n_embd)
+        self.c_proj = nn.Linear(4 * n_embd, n_embd)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x):
+        return self.dropout(self.c_proj(F.gelu(self.c_fc(x), approximate='tanh')))
+
+
+class Block(nn.Module):
+    def __init__(self, n_embd, n_head, dropout):
+        super().__init__()
+        self.ln_1 = nn.LayerNorm(n_embd, eps=1e-5)
+        self.attn = CausalSelfAttention(n_embd, n_head, dropout)
+        self.ln_2 = nn.LayerNorm(n_embd, eps=1e-5)
+        self.mlp = MLP(n_embd, dropout)
+
+    def forward(self, x, past=None, mask=None):
+        y, present = self.attn(self.ln_1(x), past, mask)
+        x = x + y
+        x = x + self.mlp(self.ln_2(x))
+        return x, present
+
+
+class NativeGPT2(nn.Module):
+    """
+    Decoder with the token layout, parameter names and computation of
+    GPT2Model driven by inputs_embeds, without the unused token embedding.
+    Linear weights are stored as (out, in), i.e. transposed from GPT-2's
+    Conv1D; convert_gpt2_state_dict maps checkpoints across. Takes and
+    returns the cache as per-layer (key, value) tuples. Unlike GPT2Model it
+    also takes explicit position_ids and a boolean attention_mask of shape
+    (new tokens, cached + new tokens), True where a token may attend.
+    """
+
+    def __init__(self, n_positions, n_embd, n_layer, n_head, dropout):
+        super().__init__()
+        self.wpe = nn.Embedding(n_positions, n_embd)
+        self.drop = nn.Dropout(dropout)
+        self.h = nn.ModuleList([Block(n_embd, n_head, dropout) for _ in range(n_layer)])
+        self.ln_f = nn.LayerNorm(n_embd, eps=1e-5)
+
+        # GPT-2 initialization, with residual projections scaled by depth.
+        for name, param in self.named_parameters():
+            if name.endswith('c_proj.weight'):
+                nn.init.normal_(param, std=0.02 / math.sqrt(2 * n_layer))
+            elif name.endswith('weight') and 'ln_' not in name:
+                nn.init.normal_(param, std=0.02)
+            elif name.endswith('bias'):
+                nn.init.zeros_(param)
+
+    def forward(self, inputs_embeds, past_key_values=None, use_cache=False,
+                position_ids=None, attention_mask=None):
+        n_past = 0 if past_key_values is None else past_key_values[0][0].shape[2]
+        if position_ids is None:
+            position_ids = torch.arange(
+                n_past, n_past + inputs_embeds.shape[1], device=inputs_embeds.device)
+        x = self.drop(inputs_embeds + self.wpe(position_ids))
+
+        presents = []
+        for i, block in enumerate(self.h):
+            x, present = block(
+                x, None if past_key_values is None else past_key_values[i], attention_mask)
+            presents.append(present)
+
+        return {
+            'last_hidden_state': self.ln_f(x),
+            'past_key_values': tuple(presents) if use_cache else None,
+        }
+
+
+def convert_gpt2_state_dict(state_dict):
+    """
+    Converts a Transformer/ImageTransformer checkpoint with the GPT2Model
+    backbone to the native backbone: Conv1D weights are transposed and the
+    token embedding and attention mask buffers dropped. GPT2 backbones were
+    always built with one head, so converted checkpoints load into native
+    models with n_head=1.
+    """
+    converted = {}
+    for key, value in state_dict.items():
+        if not key.startswith('transformer.'):
+            converted[key] = value
+        elif key == 'transformer.wte.weight' or key.endswith(('.attn.bias', '.attn.masked_bias')):
+            continue
+        elif key.endswith('.weight') and any(
+                name in key for name in ('c_attn', 'c_proj', 'c_fc')):
+            converted[key] = value.t().contiguous()
+        else:
+            converted[key] = value
+    return converted
+
+
 class Transformer(nn.Module):
     """Transformer class."""
 
@@ -22,36 +168,79 @@ class Transformer(nn.Module):
         self.action_dim = self.config['action_dim']
         self.dropout = self.config['dropout']
 
-        config = GPT2Config(
-            n_positions=4 * (1 + self.horizon),
-            n_embd=self.n_embd,
-            n_layer=self.n_layer,
-            n_head=1,
-            resid_pdrop=self.dropout,
-            embd_pdrop=self.dropout,
-            attn_pdrop=self.dropout,
-            use_cache=False,
-        )
-        self.transformer = GPT2Model(config)
+        self.backbone = self.config.get('backbone', 'gpt2')
+        if self.backbone == 'native':
+            self.transformer = NativeGPT2(
+                n_positions=4 * (1 + self.horizon),
+                n_embd=self.n_embd,
+                n_layer=self.n_layer,
+                n_head=self.n_head,
+                dropout=self.dropout,
+            )
+        elif self.backbone == 'gpt2':
+            from transformers import GPT2Config, GPT2Model
+
+            config = GPT2Config(
+                n_positions=4 * (1 + self.horizon),
+                n_embd=self.n_embd,
+                n_layer=self.n_layer,
+                n_head=1,
+                resid_pdrop=self.dropout,
+                embd_pdrop=self.dropout,
+                attn_pdrop=self.dropout,
+                use_cache=False,
+            )
+            self.transformer = GPT2Model(config)
+        else:
+            raise ValueError(f"Unknown backbone {self.backbone}")
+
+        # query_first puts the query token before the context, so the whole
+        # sequence depends on it. context_first appends the queries after
+        # the context, which can then be encoded once for any number of
+        # queries; it needs attention masks, so only the native backbone.
+        self.layout = self.config.get('layout', 'query_first')
+        if self.layout not in ('query_first', 'context_first'):
+            raise ValueError(f"Unknown layout {self.layout}")
+        if self.layout == 'context_first' and self.backbone != 'native':
+            raise ValueError("The context_first layout needs the native backbone")
 
         self.embed_transition = nn.Linear(
             2 * self.state_dim + self.action_dim + 1, self.n_embd)
         self.pred_actions = nn.Linear(self.n_embd, self.action_dim)
 
+    def embed_query(self, x):
+        # Query states are (batch, state_dim), or (batch, queries, state_dim)
+        # for several queries per context.
+        query_states = x['query_states']
+        if query_states.dim() == 2:
+            query_states = query_states[:, None, :]
+        zeros = x['zeros'][:, None, :].expand(-1, query_states.shape[1], -1)
+        seq = torch.cat([
+            query_states,
+            zeros[:, :, :self.action_dim],
+            zeros[:, :, :self.state_dim],
+            zeros[:, :, :1],
+        ], dim=2)
+        return self.embed_transition(seq)
+
+    def embed_context(self, x):
+        seq = torch.cat([
+            x['context_states'],
+            x['context_actions'],
+            x['context_next_states'],
+            x['context_rewards'],
+        ], dim=2)
+        return self.embed_transition(seq)
+
     def forward(self, x):
-        query_states = x['query_states'][:, None, :]
-        zeros = x['zeros'][:, None, :]
-
-        state_seq = torch.cat([query_states, x['context_states']], dim=1)
-        action_seq = torch.cat(
-            [zeros[:, :, :self.action_dim], x['context_actions']], dim=1)
-        next_state_seq = torch.cat(
-            [zeros[:, :, :self.state_dim], x['context_next_states']], dim=1)
-        reward_seq = torch.cat([zeros[:, :, :1], x['context_rewards']], dim=1)
-
-        seq = torch.cat(
-            [state_seq, action_seq, next_state_seq, reward_seq], dim=2)
-        stacked_inputs = self.embed_transition(seq)
+        if self.layout == 'context_first':
+            if self.test:
+                return self.predict_queries(x, self.encode_context(x))
+            if x['query_states'].dim() == 3:
+                return self.predict_query_prefixes(x, self.encode_context(x))
+            return self.predict_prefixes(x)
+
+        stacked_inputs = torch.cat([self.embed_query(x), self.embed_context(x)], dim=1)
         transformer_outputs = self.transformer(inputs_embeds=stacked_inputs)
         preds = self.pred_actions(transformer_outputs['last_hidden_state'])
 
@@ -59,6 +248,321 @@ class Transformer(nn.Module):
             return preds[:, -1, :]
         return preds[:, 1:, :]
 
+    def predict_prefixes(self, x):
+        """
+        Test-mode predictions for every prefix of the context from one
+        forward pass: entry t is the prediction given the first t + 1
+        transitions, as the causal mask hides the later ones.
+        """
+        if self.layout == 'context_first':
+            return self._predict_prefixes_context_first(x)
+        stacked_inputs = torch.cat([self.embed_query(x), self.embed_context(x)], dim=1)
+        transformer_outputs = self.transformer(inputs_embeds=stacked_inputs)
+        return self.pred_actions(transformer_outputs['last_hidden_state'])[:, 1:, :]
+
+    def _predict_prefixes_context_first(self, x):
+        # The context is followed by one copy of the query per prefix. The
+        # copy for prefix t sits at position t + 1, right after the last
+        # transition it sees, and attends to the first t + 1 transitions
+        # and itself; context tokens attend causally as usual.
+        context = self.embed_context(x)
+        n = context.shape[1]
+        queries = self.embed_query(x).expand(-1, n, -1)
+        steps = torch.arange(n, device=context.device)
+        prefix = steps[None, :] <= steps[:, None]
+        mask = torch.cat([
+            torch.cat([prefix, torch.zeros_like(prefix)], dim=1),
+            torch.cat([prefix, torch.eye(n, dtype=torch.bool, device=context.device)], dim=1),
+        ], dim=0)
+        transformer_outputs = self.transformer(
+            inputs_embeds=torch.cat([context, queries], dim=1),
+            position_ids=torch.cat([steps, steps + 1]),
+            attention_mask=mask)
+        return self.pred_actions(transformer_outputs['last_hidden_state'][:, n:, :])
+
+    def encode_context(self, x, past=None):
+        """
+        Encodes the context of x after the tokens cached in past and returns
+        the extended cache. Only for the context_first layout, where the
+        context does not depend on the query.
+        """
+        if x['context_states'].shape[1] == 0:
+            return past
+        return self.forward_cached(self.embed_context(x), past)[1]
+
+    def predict_queries(self, x, past):
+        """
+        Test-mode predictions for the queries of x after a context cached by
+        encode_context. Each query sits at the position following the
+        context and sees the context and itself only, so query states of
+        shape (batch, queries, state_dim) are all answered in one pass and
+        give (batch, queries, action_dim) predictions. The cache is left
+        unchanged.
+        """
+        queries = self.embed_query(x)
+        n_queries = queries.shape[1]
+        n_past = 0 if past is None else past[0][0].shape[2]
+        mask = torch.cat([
+            torch.ones(n_queries, n_past, dtype=torch.bool, device=queries.device),
+            torch.eye(n_queries, dtype=torch.bool, device=queries.device),
+        ], dim=1)
+        transformer_outputs = self.transformer(
+            inputs_embeds=queries, past_key_values=past,
+            position_ids=torch.full((n_queries,), n_past, device=queries.device),
+            attention_mask=mask)
+        preds = self.pred_actions(transformer_outputs['last_hidden_state'])
+        if x['query_states'].dim() == 2:
+            return preds[:, 0, :]
+        return preds
+
+    def predict_query_prefixes(self, x, past):
+        """
+        Predictions for every query of x at every prefix of a context cached
+        by encode_context, for training with several queries per context:
+        query states are (batch, queries, state_dim) and entry [:, q, t] is
+        query q's prediction given the first t + 1 transitions. The context
+        is encoded once for all queries; each query copy attends to its
+        prefix of the cache and itself, as in predict_prefixes.
+        """
+        queries = self.embed_query(x)
+        batch_size, n_queries = queries.shape[:2]
+        n = past[0][0].shape[2]
+        past = tuple(tuple(t.repeat_interleave(n_queries, dim=0) for t in layer)
+                     for layer in past)
+        queries = queries.reshape(batch_size * n_queries, 1, -1).expand(-1, n, -1)
+        steps = torch.arange(n, device=queries.device)
+        mask = torch.cat([
+            steps[None, :] <= steps[:, None],
+            torch.eye(n, dtype=torch.bool, device=queries.device),
+        ], dim=1)
+        transformer_outputs = self.transformer(
+            inputs_embeds=queries, past_key_values=past,
+            position_ids=steps + 1, attention_mask=mask)
+        preds = self.pred_actions(transformer_outputs['last_hidden_state'])
+        return preds.view(batch_size, n_queries, n, -1)
+
+    def forward_cached(self, inputs_embeds, past=None):
+        """
+        Runs embedded tokens after the tokens cached in past, a tuple of
+        per-layer (key, value) tensors of shape (batch, heads, tokens, dim).
+        Returns the action predictions for the new tokens and the cache
+        extended by them. Positions continue from the cache length.
+        """
+        if past is not None and self.backbone == 'gpt2':
+            past = _to_model_cache(past)
+        transformer_outputs = self.transformer(
+            inputs_embeds=inputs_embeds, past_key_values=past, use_cache=True)
+        preds = self.pred_actions(transformer_outputs['last_hidden_state'])
+        return preds, _from_model_cache(transformer_outputs['past_key_values'])
+
+
+def _to_model_cache(past):
+    # Older transformers take the per-layer tuples as they are; newer ones
+    # wrap them in a Cache object.
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return past
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(past)
+    return DynamicCache(past)
+
+
+def _from_model_cache(past):
+    if hasattr(past, 'layers'):
+        return tuple((layer.keys, layer.values) for layer in past.layers)
+    if hasattr(past, 'to_legacy_cache'):
+        return past.to_legacy_cache()
+    return tuple(past)
+
+
+def _context_keys(x):
+    # The context tensors of a batch; an ImageTransformer reads encoded
+    # frames instead of the images when both are given.
+    keys = [key for key in sorted(x) if key.startswith('context_') and torch.is_tensor(x[key])]
+    if 'context_image_embeddings' in keys:
+        keys.remove('context_images')
+    return keys
+
+
+def _flat(value):
+    # (batch, tokens, ...) as (batch, tokens, features), for comparisons.
+    if value.dim() == 2:
+        return value[:, :, None]
+    return value.flatten(2)
+
+
+class KVCache:
+    """
+    Incremental online inference for a Transformer. With the query_first
+    layout the query and context tokens seen so far are cached, which pays
+    off while the query stays the same across steps, as in the bandits.
+    With the context_first layout only the context is cached and the query
+    is answered on top of it, so it may change every step, as in darkroom.
+    Either way a context that grew by one transition costs one token of
+    compute. Once the context slides (it is full at H and shifts by one
+    each step), the window is re-encoded, or with evict=True the oldest
+    cached transition is dropped instead. Eviction keeps a step at one
+    token but is approximate: the remaining cached tokens keep the
+    activations they had while attending to the dropped one.
+
+    Any context_* tensors of the batch are cached, so it works for an
+    ImageTransformer too, with context_image_embeddings from a
+    FrameEmbeddingCache in place of the context images.
+    """
+
+    def __init__(self, model, evict=False):
+        self.model = model
+        self.evict = evict
+        self.context_first = getattr(model, 'layout', 'query_first') == 'context_first'
+        self.reset()
+
+    def reset(self):
+        self.past = None
+        self.query = None
+        self.context = None
+        self.preds = None
+
+    def _rebuild(self, x):
+        if self.context_first:
+            self.past = self.model.encode_context(x)
+            return
+        inputs = torch.cat([self.model.embed_query(x), self.model.embed_context(x)], dim=1)
+        preds, self.past = self.model.forward_cached(inputs)
+        self.preds = preds[:, -1, :]
+
+    def _extend(self, x, start):
+        context = {key: x[key][:, start:] for key in _context_keys(x)}
+        if self.context_first:
+            self.past = self.model.encode_context(context, self.past)
+            return
+        preds, self.past = self.model.forward_cached(
+            self.model.embed_context(context), self.past)
+        self.preds = preds[:, -1, :]
+
+    def _drop_oldest(self):
+        # With query_first token 0 is the query and token 1 the oldest
+        # cached transition; with context_first it is token 0.
+        first = 0 if self.context_first else 1
+        self.past = tuple(
+            tuple(torch.cat([t[:, :, :first], t[:, :, first + 1:]], dim=2) for t in layer)
+            for layer in self.past)
+
+    @torch.no_grad()
+    def __call__(self, x):
+        """
+        Returns the model's test-mode predictions for batch x, reusing the
+        cache when x repeats, extends or slides the previous context.
+        """
+        query = None
+        if not self.context_first:
+            query = torch.cat([
+                x[key].flatten(1) for key in sorted(x)
+                if (key.startswith('query_') or key == 'zeros') and torch.is_tensor(x[key])
+            ], dim=-1)
+        context = torch.cat([_flat(x[key]) for key in _context_keys(x)], dim=-1)
+        prev, n_prev, n = self.context, 0, context.shape[1]
+        if prev is not None:
+            n_prev = prev.shape[1]
+
+        if prev is None or (query is not None and not torch.equal(query, self.query)):
+            self._rebuild(x)
+        elif n == n_prev and torch.equal(context, prev):
+            pass
+        elif n > n_prev and torch.equal(context[:, :n_prev], prev):
+            self._extend(x, n_prev)
+        elif n == n_prev and n > 0 and torch.equal(context[:, :-1], prev[:, 1:]):
+            if self.evict:
+                self._drop_oldest()
+                self._extend(x, n - 1)
+            else:
+                self._rebuild(x)
+        else:
+            self._rebuild(x)
+
+        self.query = query
+        self.context = context
+        if self.context_first:
+            return self.model.predict_queries(x, self.past)
+        return self.preds
+
+
+class _TracedForward(nn.Module):
+    # Runs a model on the batch tensors passed positionally in keys order.
+    # With padded=True it returns the predictions for every token, so the
+    # caller can pick the one after the last real transition.
+
+    def __init__(self, model, keys, padded):
+        super().__init__()
+        self.model = model
+        self.keys = keys
+        self.padded = padded
+
+    def forward(self, *values):
+        x = dict(zip(self.keys, values))
+        if not self.padded:
+            return self.model(x)
+        stacked_inputs = torch.cat([self.model.embed_query(x), self.model.embed_context(x)], dim=1)
+        transformer_outputs = self.model.transformer(inputs_embeds=stacked_inputs)
+        return self.model.pred_actions(transformer_outputs['last_hidden_state'])
+
+
+class TracedPredictor:
+    """
+    Test-mode predictions through TorchScript traces of a Transformer, one
+    per (batch keys, batch size, context length bucket), built on first use
+    and cached. A trace replays the forward pass without the Python
+    dispatch of the dict lookups, concatenations and modules. With the
+    query_first layout contexts are zero-padded at the end up to a multiple
+    of bucket (or the horizon), which the causal mask hides from the token
+    read out, so a context growing step by step reuses few traces. context_first contexts
+    are traced per exact length. Traces are frozen, so the model must not
+    change after tracing. They run in float32 and are not meant to be
+    called under autocast.
+    """
+
+    def __init__(self, model, bucket=16):
+        self.model = model
+        self.bucket = bucket
+        self.padded = getattr(model, 'layout', 'query_first') == 'query_first'
+        self.traces = {}
+
+    def _pad(self, value, n):
+        if value.shape[1] == n:
+            return value
+        padding = value.new_zeros(value.shape[0], n - value.shape[1], *value.shape[2:])
+        return torch.cat([value, padding], dim=1)
+
+    @torch.no_grad()
+    def __call__(self, x):
+        keys = tuple(key for key in sorted(x) if torch.is_tensor(x[key]))
+        if 'context_image_embeddings' in keys:
+            keys = tuple(key for key in keys if key != 'context_images')
+        n = x['context_states'].shape[1]
+        n_traced = n
+        if self.padded:
+            # A full context (of the model's horizon) is never padded.
+            n_traced = max(n, min(self.bucket * -(-n // self.bucket), self.model.horizon))
+        values = tuple(self._pad(x[key], n_traced) if key.startswith('context') else x[key]
+                       for key in keys)
+
+        trace_key = (keys, x['query_states'].shape[0], n_traced)
+        if trace_key not in self.traces:
+            forward = _TracedForward(self.model, keys, self.padded)
+            # Frozen traces inline the weights as constants, which freeze
+            # only allows outside training mode. The model's own mode is
+            # left as it is.
+            forward.training = False
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', torch.jit.TracerWarning)
+                traced = torch.jit.trace(forward, values, check_trace=False)
+            self.traces[trace_key] = torch.jit.freeze(traced)
+        preds = self.traces[trace_key](*values)
+        if self.padded:
+            # Token 0 is the query and token n the last real transition.
+            return preds[:, n, :]
+        return preds
+
 
 class ImageTransformer(Transformer):
     """Transformer class for image-based data."""
@@ -86,47 +590,100 @@ class ImageTransformer(Transformer):
         self.embed_transition = torch.nn.Linear(new_dim, self.n_embd)
         self.embed_ln = nn.LayerNorm(self.n_embd)
 
-    def forward(self, x):
-        query_images = x['query_images'][:, None, :]
-        query_states = x['query_states'][:, None, :]
-        context_images = x['context_images']
-        context_states = x['context_states']
-        context_actions = x['context_actions']
-        context_rewards = x['context_rewards']
+    def encode_images(self, images):
+        batch_size, n_images = images.shape[:2]
+        images = images.reshape(-1, *images.shape[2:])
+        return self.image_encoder(images).view(batch_size, n_images, self.im_embd)
 
+    def embed_query(self, x):
+        query_states = x['query_states']
+        query_images = x['query_images']
+        if query_states.dim() == 2:
+            query_states = query_states[:, None, :]
+            query_images = query_images[:, None]
+        batch_size, n_queries = query_states.shape[:2]
+        seq = torch.cat([
+            self.encode_images(query_images),
+            query_states,
+            torch.zeros(batch_size, n_queries, self.action_dim, device=query_states.device),
+            torch.zeros(batch_size, n_queries, 1, device=query_states.device),
+        ], dim=2)
+        return self.embed_ln(self.embed_transition(seq))
+
+    def embed_context(self, x):
+        # Deployment may pass the context frames already encoded, see
+        # FrameEmbeddingCache.
+        if 'context_image_embeddings' in x:
+            image_embeddings = x['context_image_embeddings']
+        else:
+            image_embeddings = self.encode_images(x['context_images'])
+        context_rewards = x['context_rewards']
         if len(context_rewards.shape) == 2:
             context_rewards = context_rewards[:, :, None]
+        seq = torch.cat([
+            image_embeddings,
+            x['context_states'],
+            x['context_actions'],
+            context_rewards,
+        ], dim=2)
+        return self.embed_ln(self.embed_transition(seq))
 
-        batch_size = query_states.shape[0]
 
-        image_seq = torch.cat([query_images, context_images], dim=1)
-        image_seq = image_seq.view(-1, *image_seq.size()[2:])
+class FrameEmbeddingCache:
+    """
+    Image encoder outputs of the context frames of an ImageTransformer
+    during deployment. The context is fixed within an episode and between
+    episodes only gains new frames at the end (and drops old ones at the
+    start once it is full), so each frame is encoded once, when it enters
+    the context, instead of at every step.
+    """
 
-        image_enc_seq = self.image_encoder(image_seq)
-        image_enc_seq = image_enc_seq.view(batch_size, -1, self.im_embd)
+    def __init__(self, model):
+        self.model = model
+        self.reset()
 
-        context_states = torch.cat([query_states, context_states], dim=1)
-        context_actions = torch.cat([
-            torch.zeros(batch_size, 1, self.action_dim).to(device),
-            context_actions,
-        ], dim=1)
-        context_rewards = torch.cat([
-            torch.zeros(batch_size, 1, 1).to(device),
-            context_rewards,
-        ], dim=1)
+    def reset(self):
+        self.images = None
+        self.embeddings = None
 
-        stacked_inputs = torch.cat([
-            image_enc_seq,
-            context_states,
-            context_actions,
-            context_rewards,
-        ], dim=2)
-        stacked_inputs = self.embed_transition(stacked_inputs)
-        stacked_inputs = self.embed_ln(stacked_inputs)
+    def _shift(self, images):
+        # Returns the number of frames dropped from the start of the
+        # previous context if images continue it, else None.
+        prev = self.images
+        if prev is None or prev.shape[1] == 0 or images.shape[1] == 0:
+            return None
+        first = (prev == images[:, :1]).flatten(2).all(dim=2).all(dim=0)
+        for shift in torch.nonzero(first).flatten().tolist():
+            n = min(prev.shape[1] - shift, images.shape[1])
+            if torch.equal(prev[:, shift:shift + n], images[:, :n]):
+                return shift
+        return None
 
-        transformer_outputs = self.transformer(inputs_embeds=stacked_inputs)
-        preds = self.pred_actions(transformer_outputs['last_hidden_state'])
+    @torch.no_grad()
+    def __call__(self, images):
+        """
+        Returns the (batch, frames, im_embd) encodings of context images,
+        encoding only the frames that were not in the previous context.
+        """
+        shift = self._shift(images)
+        if shift is None:
+            embeddings = self.model.encode_images(images)
+        else:
+            kept = self.embeddings[:, shift:shift + images.shape[1]]
+            embeddings = torch.cat(
+                [kept, self.model.encode_images(images[:, kept.shape[1]:])], dim=1)
+        self.images = images
+        self.embeddings = embeddings
+        return embeddings
 
-        if self.test:
-            return preds[:, -1, :]
-        return preds[:, 1:, :]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert GPT2-backbone checkpoints to the native backbone")
+    parser.add_argument("src", type=str, help="GPT2-backbone checkpoint")
+    parser.add_argument("dst", type=str, help="Converted checkpoint")
+    args = vars(parser.parse_args())
+
+    state_dict = torch.load(args['src'], map_location='cpu')
+    torch.save(convert_gpt2_state_dict(state_dict), args['dst'])
+    print(f"Converted {args['src']} to {args['dst']}.")
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from columnar import FORMAT_VERSION, is_columnar, load_header
+
+# Bump whenever collect_data.py generates different data for the same
+# config, so that datasets generated before get new keys and are never
+# reused. Edits that leave the generated data as it is (refactors, eval
+# controllers, logging) keep the version and all cached datasets.
+GENERATOR_VERSION = 2
+
+
+def _digest(obj):
+    encoded = json.dumps(obj, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def dataset_key(env, mode, config, seed, chunk_size):
+    """
+    Hashes everything a dataset split depends on except the envs it covers:
+    the full generation config, the seed, the chunking and the generator
+    version.
+    Mode is either 0: train, 1: test, 2: eval.
+    """
+    return _digest({
+        'env': env,
+        'mode': mode,
+        'config': config,
+        'seed': int(seed),
+        'chunk_size': chunk_size,
+        'generator_version': GENERATOR_VERSION,
+        'format_version': FORMAT_VERSION,
+    })
+
+
+def chunk_tags(key, chunks):
+    """
+    Tags each chunk of envs (a number of envs to sample, or an array of
+    goals/env ids) together with the dataset key and its position, which
+    seeds it. Equal tags mean the chunk is generated identically.
+    """
+    return [_digest([key, i, c if np.isscalar(c) else np.asarray(c).tolist()])
+            for i, c in enumerate(chunks)]
+
+
+def common_prefix(tags, other):
+    n = 0
+    while n < min(len(tags), len(other)) and tags[n] == other[n]:
+        n += 1
+    return n
+
+
+def find_datasets(key, root='datasets'):
+    """
+    Yields (path, header) for every complete dataset under root that was
+    generated with key.
+    """
+    if not os.path.isdir(root):
+        return
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if not is_columnar(path):
+            continue
+        header = load_header(path)
+        if header['meta'].get('key') == key and 'chunks' in header:
+            yield path, header
+
+
+def best_source(key, tags, root='datasets'):
+    """
+    Returns (path, n_chunks) of the registered dataset sharing the longest
+    prefix of chunks with tags, or (None, 0) if none does.
+    """
+    best = (None, 0)
+    for path, header in find_datasets(key, root):
+        n = common_prefix(tags, [chunk['tag'] for chunk in header['chunks']])
+        if n > best[1]:
+            best = (path, n)
+    return best
+
+
+def check_dataset(path, env, mode, config):
+    """
+    Raises ValueError unless the dataset at path is complete and was
+    generated by the current generator for env, mode and the entries of
+    config, checked by recomputing its key from its header. Legacy pickles
+    and converted datasets carry no key and are only warned about.
+    """
+    if not is_columnar(path):
+        if os.path.isfile(path):
+            print(f"Warning: {path} is a legacy pickle and cannot be checked.")
+            return
+        raise ValueError(f"No complete dataset at {path}, run collect_data.py first.")
+
+    meta = load_header(path)['meta']
+    if 'key' not in meta:
+        print(f"Warning: {path} was not generated with a key and cannot be checked.")
+        return
+    if 'seed' not in meta or meta['key'] != dataset_key(
+            meta['env'], meta['mode'], meta['config'], meta['seed'], meta['chunk_size']):
+        raise ValueError(
+            f"{path} was generated by another generator version, "
+            "regenerate it with collect_data.py.")
+    if meta['env'] != env or meta['mode'] != mode:
+        raise ValueError(
+            f"{path} holds {meta['env']} split {meta['mode']}, not {env} split {mode}.")
+    config = json.loads(json.dumps(config))
+    changed = sorted(key for key, value in config.items()
+                     if key in meta['config'] and meta['config'][key] != value)
+    if changed:
+        raise ValueError(f"{path} was generated with different {', '.join(changed)}.")
@@ -1,4 +1,7 @@
-# Collect data by running the below up to 60,000
+# Collect data with a pool of worker processes into a single merged dataset
+# xvfb-run -a -s "-screen 0 1024x768x24 -ac +extension GLX +render -noreset" python3 collect_data.py --env miniworld --envs 60000 --H 50 --workers 12
+
+# Alternatively, collect data in shards by running the below up to 60,000
 # xvfb-run -a -s "-screen 0 1024x768x24 -ac +extension GLX +render -noreset" python3 collect_data.py --env miniworld --H 50 --env_id_start 0 --env_id_end 4999
 # xvfb-run -a -s "-screen 0 1024x768x24 -ac +extension GLX +render -noreset" python3 collect_data.py --env miniworld --H 50 --env_id_start 5000 --env_id_end 9999
 # ...
@@ -14,7 +14,15 @@ from torchvision.transforms import transforms
 import numpy as np
 import common_args
 import random
-from dataset import Dataset, ImageDataset
+import registry
+from columnar import dataset_exists
+from dataset import (
+    BatchLoader,
+    Dataset,
+    ImageDataset,
+    Prefetcher,
+    ProceduralDataset,
+)
 from net import Transformer, ImageTransformer
 from utils import (
     build_bandit_data_filename,
@@ -25,6 +33,7 @@ from utils import (
     build_darkroom_model_filename,
     build_miniworld_data_filename,
     build_miniworld_model_filename,
+    autocast,
     worker_init_fn,
 )
 
@@ -52,6 +61,8 @@ if __name__ == '__main__':
     n_hists = args['hists']
     n_samples = args['samples']
     horizon = args['H']
+    if isinstance(horizon, list):
+        horizon = horizon[0]    # several context sizes are only used by eval.py
     dim = args['dim']
     state_dim = dim
     action_dim = dim
@@ -97,6 +108,9 @@ if __name__ == '__main__':
         'n_embd': n_embd,
         'n_layer': n_layer,
         'n_head': n_head,
+        'backbone': args['backbone'],
+        'layout': args['layout'],
+        'procedural': args['procedural'],
         'n_envs': n_envs,
         'n_hists': n_hists,
         'n_samples': n_samples,
@@ -174,6 +188,15 @@ if __name__ == '__main__':
             paths_train.append(path_train)
             paths_test.append(path_test)
 
+        # Prefer a single merged dataset collected with --workers
+        path_train = build_miniworld_data_filename(
+            env, 0, n_envs, dataset_config, mode=0)
+        path_test = build_miniworld_data_filename(
+            env, 0, n_envs, dataset_config, mode=1)
+        if dataset_exists(path_train) and dataset_exists(path_test):
+            paths_train = [path_train]
+            paths_test = [path_test]
+
         filename = build_miniworld_model_filename(env, model_config)
         print(f"Generate filename: {filename}")
 
@@ -187,13 +210,20 @@ if __name__ == '__main__':
         'n_layer': n_layer,
         'n_embd': n_embd,
         'n_head': n_head,
+        'backbone': args['backbone'],
+        'layout': args['layout'],
         'shuffle': shuffle,
+        'batch_shuffle': not args['per_sample_shuffle'],
         'dropout': dropout,
         'test': False,
         'store_gpu': True,
     }
     if env == 'miniworld':
-        config.update({'image_size': 25, 'store_gpu': False})
+        config.update({
+            'image_size': 25,
+            'store_gpu': False,
+            'image_cache': None if args['image_cache'] == 'none' else args['image_cache'],
+        })
         model = ImageTransformer(config).to(device)
     else:
         model = Transformer(config).to(device)
@@ -217,6 +247,17 @@ if __name__ == '__main__':
         with open(log_filename, 'a') as f:
             print(string, file=f)
 
+    # With prefetching, the time each step waited for its batch, one line
+    # per step: epoch, split, step and milliseconds.
+    wait_filename = f'figs/loss/{filename}_data_wait.txt'
+    if args['prefetch'] > 0:
+        with open(wait_filename, 'w') as f:
+            pass
+    def log_waits(epoch, split, loader):
+        with open(wait_filename, 'a') as f:
+            for step, wait in enumerate(loader.step_wait_times()):
+                print(f"{epoch + 1} {split} {step} {1000 * wait:.3f}", file=f)
+
 
 
 
@@ -238,16 +279,66 @@ if __name__ == '__main__':
             })
 
 
+        for path_train, path_test in zip(paths_train, paths_test):
+            registry.check_dataset(path_train, env, 0, dataset_config)
+            registry.check_dataset(path_test, env, 1, dataset_config)
         printw("Loading miniworld data...")
         train_dataset = ImageDataset(paths_train, config, transform)
         test_dataset = ImageDataset(paths_test, config, transform)
         printw("Done loading miniworld data")
+        # Loaders draw their order and worker seeds from their own
+        # generators, not from the global RNG the model's dropout uses.
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset, collate_fn=train_dataset.collate,
+            generator=torch.Generator().manual_seed(tmp_seed), **params)
+        test_loader = torch.utils.data.DataLoader(
+            test_dataset, collate_fn=test_dataset.collate,
+            generator=torch.Generator().manual_seed(tmp_seed + 1), **params)
+    elif args['procedural']:
+        # Fresh tasks every epoch, with as many samples per epoch as the
+        # collected datasets would hold. Test tasks are the same each epoch.
+        n_train = int(.8 * n_envs) * n_hists * n_samples
+        n_test = (n_envs - int(.8 * n_envs)) * n_hists * n_samples
+        train_dataset = ProceduralDataset(
+            env, dataset_config, config, n_train, seed=tmp_seed, batch_size=params['batch_size'])
+        test_dataset = ProceduralDataset(
+            env, dataset_config, config, n_test, seed=tmp_seed, split=1, fixed=True,
+            batch_size=params['batch_size'])
+
+        loader_params = {
+            'batch_size': params['batch_size'],
+            'num_workers': args['data_workers'],
+            'persistent_workers': args['data_workers'] > 0,
+        }
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset, collate_fn=train_dataset.collate,
+            generator=torch.Generator().manual_seed(tmp_seed), **loader_params)
+        test_loader = torch.utils.data.DataLoader(
+            test_dataset, collate_fn=test_dataset.collate,
+            generator=torch.Generator().manual_seed(tmp_seed + 1), **loader_params)
     else:
+        registry.check_dataset(path_train, env, 0, dataset_config)
+        registry.check_dataset(path_test, env, 1, dataset_config)
         train_dataset = Dataset(path_train, config)
         test_dataset = Dataset(path_test, config)
 
-    train_loader = torch.utils.data.DataLoader(train_dataset, **params)
-    test_loader = torch.utils.data.DataLoader(test_dataset, **params)
+        # Samples are gathered a whole batch at a time on the data's device.
+        # A context_first model trained on several queries per context gets
+        # whole contexts, so it encodes each once for all of its queries.
+        per_context = args['layout'] == 'context_first' and n_samples > 1 \
+            and train_dataset.queries_per_context == test_dataset.queries_per_context == n_samples
+        train_loader = BatchLoader(
+            train_dataset, params['batch_size'], shuffle=params['shuffle'], seed=tmp_seed,
+            per_context=per_context)
+        test_loader = BatchLoader(
+            test_dataset, params['batch_size'], shuffle=params['shuffle'], seed=tmp_seed + 1,
+            per_context=per_context)
+
+    if args['prefetch'] > 0:
+        # Batches are collated and moved to the device ahead of the step,
+        # so the loops below only move them when there is no prefetcher.
+        train_loader = Prefetcher(train_loader, device, depth=args['prefetch'])
+        test_loader = Prefetcher(test_loader, device, depth=args['prefetch'])
 
     optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=1e-4)
     loss_fn = torch.nn.CrossEntropyLoss(reduction='sum')
@@ -266,13 +357,14 @@ if __name__ == '__main__':
             epoch_test_loss = 0.0
             for i, batch in enumerate(test_loader):
                 print(f"Batch {i} of {len(test_loader)}", end='\r')
-                batch = {k: v.to(device) for k, v in batch.items()}
+                if args['prefetch'] == 0:
+                    batch = {k: v.to(device) for k, v in batch.items()}
                 true_actions = batch['optimal_actions']
-                pred_actions = model(batch)
-                true_actions = true_actions.unsqueeze(
-                    1).repeat(1, pred_actions.shape[1], 1)
+                with autocast(args['precision']):
+                    pred_actions = model(batch)
+                true_actions = true_actions.unsqueeze(-2).expand(*pred_actions.shape[:-1], -1)
                 true_actions = true_actions.reshape(-1, action_dim)
-                pred_actions = pred_actions.reshape(-1, action_dim)
+                pred_actions = pred_actions.reshape(-1, action_dim).float()
 
                 loss = loss_fn(pred_actions, true_actions)
                 epoch_test_loss += loss.item() / horizon
@@ -281,6 +373,9 @@ if __name__ == '__main__':
         end_time = time.time()
         printw(f"\tTest loss: {test_loss[-1]}")
         printw(f"\tEval time: {end_time - start_time}")
+        if args['prefetch'] > 0:
+            printw(f"\tEval data wait: {test_loader.wait_summary()}")
+            log_waits(epoch, 'test', test_loader)
 
 
         # TRAINING
@@ -289,13 +384,14 @@ if __name__ == '__main__':
 
         for i, batch in enumerate(train_loader):
             print(f"Batch {i} of {len(train_loader)}", end='\r')
-            batch = {k: v.to(device) for k, v in batch.items()}
+            if args['prefetch'] == 0:
+                batch = {k: v.to(device) for k, v in batch.items()}
             true_actions = batch['optimal_actions']
-            pred_actions = model(batch)
-            true_actions = true_actions.unsqueeze(
-                1).repeat(1, pred_actions.shape[1], 1)
+            with autocast(args['precision']):
+                pred_actions = model(batch)
+            true_actions = true_actions.unsqueeze(-2).expand(*pred_actions.shape[:-1], -1)
             true_actions = true_actions.reshape(-1, action_dim)
-            pred_actions = pred_actions.reshape(-1, action_dim)
+            pred_actions = pred_actions.reshape(-1, action_dim).float()
 
             optimizer.zero_grad()
             loss = loss_fn(pred_actions, true_actions)
@@ -307,6 +403,9 @@ if __name__ == '__main__':
         end_time = time.time()
         printw(f"\tTrain loss: {train_loss[-1]}")
         printw(f"\tTrain time: {end_time - start_time}")
+        if args['prefetch'] > 0:
+            printw(f"\tTrain data wait: {train_loader.wait_summary()}")
+            log_waits(epoch, 'train', train_loader)
 
 
         # LOGGING
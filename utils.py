@@ -55,6 +55,12 @@ def build_bandit_model_filename(env, config):
     filename += '_H' + str(config['horizon'])
     filename += '_d' + str(config['dim'])
     filename += '_seed' + str(config['seed'])
+    if config.get('backbone', 'gpt2') != 'gpt2':
+        filename += '_' + config['backbone']
+    if config.get('layout', 'query_first') != 'query_first':
+        filename += '_' + config['layout']
+    if config.get('procedural', False):
+        filename += '_procedural'
     return filename
 
 def build_linear_bandit_data_filename(env, n_envs, config, mode):
@@ -103,6 +109,12 @@ def build_linear_bandit_model_filename(env, config):
     filename += '_d' + str(config['dim'])
     filename += '_lind' + str(config['lin_d'])
     filename += '_seed' + str(config['seed'])
+    if config.get('backbone', 'gpt2') != 'gpt2':
+        filename += '_' + config['backbone']
+    if config.get('layout', 'query_first') != 'query_first':
+        filename += '_' + config['layout']
+    if config.get('procedural', False):
+        filename += '_procedural'
     return filename
 
 def build_darkroom_data_filename(env, n_envs, config, mode):
@@ -146,6 +158,12 @@ def build_darkroom_model_filename(env, config):
     filename += '_H' + str(config['horizon'])
     filename += '_d' + str(config['dim'])
     filename += '_seed' + str(config['seed'])
+    if config.get('backbone', 'gpt2') != 'gpt2':
+        filename += '_' + config['backbone']
+    if config.get('layout', 'query_first') != 'query_first':
+        filename += '_' + config['layout']
+    if config.get('procedural', False):
+        filename += '_procedural'
     return filename
 
 
@@ -187,9 +205,25 @@ def build_miniworld_model_filename(env, config):
     filename += '_samples' + str(config['n_samples'])
     filename += '_H' + str(config['horizon'])
     filename += '_seed' + str(config['seed'])
+    if config.get('backbone', 'gpt2') != 'gpt2':
+        filename += '_' + config['backbone']
+    if config.get('layout', 'query_first') != 'query_first':
+        filename += '_' + config['layout']
+    if config.get('procedural', False):
+        filename += '_procedural'
     return filename
 
 
+def autocast(precision):
+    """
+    Context manager running a model in precision ('fp32' or 'bf16'). With
+    bf16, matmuls run in bfloat16 under autocast while the parameters stay
+    float32. Outputs are bfloat16 and should be cast back with .float().
+    """
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                          enabled=precision == 'bf16')
+
+
 def convert_to_tensor(x, store_gpu=True):
     if store_gpu:
         return torch.tensor(np.asarray(x)).float().to(device)